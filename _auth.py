@@ -1,22 +1,185 @@
-from flask import request, session, redirect, url_for
+import os
+import time
+from threading import Lock, Thread
+from glob import glob
+from flask import request, session, redirect, url_for, g
 from hashlib import sha256
 from base64 import urlsafe_b64encode
-from typing import Literal, cast
+from typing import Literal, Callable, Any, cast
+from concurrent.futures import ThreadPoolExecutor
 from functools import wraps
 from flask_login import login_required, login_user, current_user # type: ignore[import-untyped]
 from _users import load_user, User # type: ignore[import-untyped]
-from _util import generate_user_hash
+from _util import generate_user_hash, read_textual, write_textual, strip_ext
+from _pignio import USERS_ROOT, ITEMS_EXT, TOKENS_USAGE_LIST, METRICS, Config
 from _functions import redirect_next, noindex
 from _app_factory import app
 
+# resolved once per request, since permission checks can ask for it many times
 def verify_token_auth() -> User|Literal[False]:
+    if "token_user" not in g:
+        g.token_user = resolve_token_auth()
+    return g.token_user
+
+def resolve_token_auth() -> User|Literal[False]:
     if (auth := request.headers.get("Authorization", "")).startswith("Bearer "):
         [username, token] = auth.split(" ")[1].split(":")
-        if ((user := load_user(username)) and check_user_token(cast(list[str], user.data.get("tokens", [])), hash_api_token(token))):
+        if token_registry.resolve(hash_api_token(token)) == username and (user := load_user(username)):
             user.__dict__["is_authenticated"] = True
             return user
     return False
 
+# all API tokens by hash, so that a request is authenticated with a single lookup; usage is only counted in memory, and saved from time to time
+class TokenRegistry:
+    def __init__(self):
+        self.tokens: dict[str, tuple[str, float]] = {}
+        self.usage: dict[str, tuple[int, float]] = {}
+        self.lock = Lock()
+        self.changed = False
+        self.edits = 0
+
+    def load(self) -> None:
+        edits = self.edits
+        tokens = {}
+        for filepath in glob(f"{USERS_ROOT}/*{ITEMS_EXT}"):
+            tokens.update(self.user_tokens(strip_ext(os.path.basename(filepath))))
+        usage = {}
+        if os.path.exists(TOKENS_USAGE_LIST):
+            for line in read_textual(TOKENS_USAGE_LIST).splitlines():
+                try:
+                    [hashed, count_text, last_text] = line.split()
+                    usage[hashed] = (int(count_text), float(last_text))
+                except ValueError:
+                    app.logger.warning(f"Skipping malformed line in {TOKENS_USAGE_LIST}: {line!r}")
+        with self.lock:
+            # a token created or deleted meanwhile might be missing from what was read, so keep the current ones until the next round
+            if edits == self.edits:
+                self.tokens = tokens
+            for hashed, (count, last) in usage.items():
+                if hashed not in self.usage:
+                    self.usage[hashed] = (count, last)
+
+    def user_tokens(self, username:str) -> dict[str, tuple[str, float]]:
+        tokens = {}
+        if (user := load_user(username)):
+            for token in cast(list[str], user.data.get("tokens", [])):
+                try:
+                    [timestamp, hashed] = token.split(":")
+                    tokens[hashed] = (user.username, float(timestamp))
+                except (AttributeError, ValueError):
+                    app.logger.warning(f"Skipping malformed API token of {user.username}: {token!r}")
+        return tokens
+
+    # for when the file of a single user changed on disk
+    def reload_user(self, username:str) -> None:
+        tokens = self.user_tokens(username)
+        with self.lock:
+            self.tokens = {hashed: entry for hashed, entry in self.tokens.items() if entry[0] != username} | tokens
+            self.edits += 1
+
+    def resolve(self, hashed:str) -> str|None:
+        if (entry := self.tokens.get(hashed)):
+            with self.lock:
+                count, last = self.usage.get(hashed, (0, 0))
+                self.usage[hashed] = (count + 1, time.time())
+                self.changed = True
+            return entry[0]
+        return None
+
+    def add(self, username:str, token:str) -> None:
+        [timestamp, hashed] = token.split(":")
+        with self.lock:
+            self.tokens[hashed] = (username, float(timestamp))
+            self.edits += 1
+
+    def remove(self, hashed:str) -> None:
+        with self.lock:
+            self.tokens.pop(hashed, None)
+            self.edits += 1
+            self.changed = self.usage.pop(hashed, None) != None or self.changed
+
+    def get_usage(self, hashed:str) -> tuple[int, float|None]:
+        count, last = self.usage.get(hashed, (0, 0))
+        return (count, last or None)
+
+    def flush(self) -> None:
+        with self.lock:
+            if not self.changed:
+                return
+            lines = [f"{hashed} {count} {last}" for hashed, (count, last) in self.usage.items() if hashed in self.tokens]
+            self.changed = False
+        write_textual(TOKENS_USAGE_LIST, "\n".join(lines), False)
+
+    # tokens added or removed by editing user files by hand are picked up here too
+    def run(self) -> None:
+        while True:
+            time.sleep(TOKENS_FLUSH_SECONDS)
+            try:
+                self.flush()
+                self.load()
+            except Exception:
+                app.logger.exception("Token registry error")
+
+    def stats(self) -> dict[str, int]:
+        return {"Tokens": len(self.tokens), "Requests": sum(count for count, last in self.usage.values())}
+
+TOKENS_FLUSH_SECONDS = 60
+
+class HasherBusy(Exception):
+    pass
+
+# password hashing is slow on purpose, so it runs on a few dedicated threads; requests beyond the queue bound, or too many at once for the same user or client, are turned away right away
+class PasswordHasher:
+    def __init__(self, workers:int, queue:int, per_client:int):
+        self.workers = workers
+        self.limit = workers + queue
+        self.per_client = per_client
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="password-hasher")
+        self.lock = Lock()
+        self.pending = 0
+        self.inflight: dict[str, int] = {}
+        self.completed = self.rejected = 0
+        self.latency_last = self.latency_max = self.latency_total = 0.0
+
+    def run(self, username:str, function:Callable[..., Any], *args) -> Any:
+        limits = {f"user:{username}": 1}
+        if self.per_client:
+            limits[f"client:{request.remote_addr}"] = self.per_client
+        with self.lock:
+            if self.pending >= self.limit or any(self.inflight.get(key, 0) >= limit for key, limit in limits.items()):
+                self.rejected += 1
+                raise HasherBusy()
+            self.pending += 1
+            for key in limits:
+                self.inflight[key] = self.inflight.get(key, 0) + 1
+        start = time.time()
+        try:
+            return self.executor.submit(function, *args).result()
+        finally:
+            with self.lock:
+                self.pending -= 1
+                for key in limits:
+                    if (count := self.inflight[key] - 1):
+                        self.inflight[key] = count
+                    else:
+                        del self.inflight[key]
+                self.completed += 1
+                self.latency_last = time.time() - start
+                self.latency_max = max(self.latency_max, self.latency_last)
+                self.latency_total += self.latency_last
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            "Workers": self.workers,
+            "Queue depth": max(0, self.pending - self.workers),
+            "In progress": min(self.pending, self.workers),
+            "Completed": self.completed,
+            "Rejected": self.rejected,
+            "Last latency (s)": round(self.latency_last, 3),
+            "Max latency (s)": round(self.latency_max, 3),
+            "Average latency (s)": round(self.latency_total / (self.completed or 1), 3),
+        }
+
 def check_user_token(tokens:list[str], hashed:str) -> str|Literal[False]:
     for token in tokens:
         if token.endswith(f":{hashed}"):
@@ -61,3 +224,9 @@ def auth_required_config(config_value:bool):
             return f(*args, **kwargs) if (not config_value or is_request_authed()) else app.login_manager.unauthorized()
         return wrapper
     return decorator
+
+token_registry = TokenRegistry()
+METRICS["API Tokens"] = token_registry.stats
+
+password_hasher = PasswordHasher(Config.PASSWORD_HASH_WORKERS, Config.PASSWORD_HASH_QUEUE, Config.PASSWORD_HASH_PER_CLIENT)
+METRICS["Password Hashing"] = password_hasher.stats
@@ -0,0 +1,95 @@
+import os
+import time
+from collections import OrderedDict
+from threading import Lock
+from typing import Any, Iterable
+
+class LRUCache:
+    # with `recheck_seconds`, files are stat'ed again only once that much time has passed since an entry was last validated
+    def __init__(self, name:str, max_entries:int, max_bytes:int=0, recheck_seconds:float=0):
+        self.name = name
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.recheck_seconds = recheck_seconds
+        self.entries: OrderedDict[str, tuple[Any, tuple[str, ...], tuple, int, float]] = OrderedDict()
+        self.size = 0
+        self.hits = self.misses = self.evictions = self.invalidations = 0
+        self.lock = Lock()
+        CACHES.append(self)
+
+    def get(self, key:str) -> Any:
+        with self.lock:
+            entry = self.entries.get(key)
+        if entry:
+            value, paths, stamp, size, checked = entry
+            if (fresh := self.recheck_seconds and time.time() - checked < self.recheck_seconds) or stamp_paths(paths) == stamp:
+                with self.lock:
+                    if key in self.entries:
+                        self.entries.move_to_end(key)
+                        if not fresh and self.recheck_seconds:
+                            self.entries[key] = (value, paths, stamp, size, time.time())
+                    self.hits += 1
+                return value
+            self.invalidate(key)
+        with self.lock:
+            self.misses += 1
+        return None
+
+    # `paths` are the files (or folders) the value was derived from, the entry is dropped as soon as any of them changes on disk;
+    #  `stamp` should be taken with stamp_paths() before reading them, or a change saved while they were being read would go unnoticed
+    def put(self, key:str, value:Any, paths:Iterable[str]=(), size:int=0, stamp:tuple|None=None) -> None:
+        if self.max_entries <= 0:
+            return
+        paths = tuple(paths)
+        stamp = (stamp if stamp != None else stamp_paths(paths))
+        with self.lock:
+            if (old := self.entries.pop(key, None)):
+                self.size -= old[3]
+            self.entries[key] = (value, paths, stamp, size, time.time())
+            self.size += size
+            while len(self.entries) > self.max_entries or (self.max_bytes and self.size > self.max_bytes and len(self.entries) > 1):
+                self.size -= self.entries.popitem(last=False)[1][3]
+                self.evictions += 1
+
+    def invalidate(self, key:str) -> bool:
+        with self.lock:
+            if (old := self.entries.pop(key, None)):
+                self.size -= old[3]
+                self.invalidations += 1
+                return True
+        return False
+
+    def clear(self) -> None:
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def stats(self) -> dict[str, int|str]:
+        return {
+            "name": self.name,
+            "entries": len(self.entries),
+            "bytes": self.size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+        }
+
+def stamp_paths(paths:tuple[str, ...]) -> tuple:
+    stamp: list[tuple[int, int]|None] = []
+    for path in paths:
+        try:
+            stat = os.stat(path)
+            stamp.append((stat.st_mtime_ns, stat.st_size))
+        except OSError:
+            stamp.append(None)
+    return tuple(stamp)
+
+def estimate_size(data:Any) -> int:
+    if type(data) == dict:
+        return sum(len(key) + estimate_size(value) for key, value in data.items())
+    elif type(data) in (list, tuple):
+        return sum(estimate_size(value) for value in data)
+    return len(str(data))
+
+CACHES: list[LRUCache] = []
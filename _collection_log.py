@@ -0,0 +1,153 @@
+import os
+import urllib.parse
+from threading import Lock, get_ident
+from shutil import copyfile
+from typing import Any, Callable, cast
+from collections import OrderedDict
+from _pignio import MetaDict, ITEMS_EXT, LISTS_EXT, Config
+from _util import read_metadata_file, write_metadata, mkfiledir
+from _cache import stamp_paths
+
+# called with the path and items of a collection whenever these are (re)loaded from disk, as after being edited by hand
+reload_hooks: list[Callable[[str, list[str]], Any]] = []
+
+# the log is folded back into the .ini file once it holds this many changes
+COMPACT_ENTRIES = 256
+# collections kept in memory, past which the least recently used ones are dropped, to be read again from disk when needed
+MAX_COLLECTIONS = 1024
+
+def get_log_path(filepath:str) -> str:
+    return f"{filepath.removesuffix(ITEMS_EXT)}.log{LISTS_EXT}"
+
+# the items of a collection as stored on disk, that is its .ini file with the log replayed on top, along with how many changes the log holds
+def read_collection(filepath:str, logpath:str|None=None) -> tuple[dict[str, None], int]:
+    try:
+        items = dict.fromkeys(cast(list[str], read_metadata_file(filepath).get("items", [])))
+    except FileNotFoundError:
+        items = {}
+    entries = 0
+    try:
+        with open(logpath or get_log_path(filepath), "r", encoding="utf-8") as f:
+            for line in f:
+                if (line := line.strip()):
+                    if line[0] == "+":
+                        items[urllib.parse.unquote(line[1:])] = None
+                    else:
+                        items.pop(urllib.parse.unquote(line[1:]), None)
+                    entries += 1
+    except FileNotFoundError:
+        pass
+    return items, entries
+
+# items of a collection, kept in memory as an ordered set; pins and unpins are appended to a log next to the .ini file, instead of rewriting it each time
+class CollectionItems:
+    def __init__(self, filepath:str):
+        self.filepath = filepath
+        self.logpath = get_log_path(filepath)
+        self.lock = Lock()
+        self.items: dict[str, None] = {}
+        self.entries = 0
+        self.stamp: tuple|None = None
+        self.derived: dict[str, tuple[tuple|None, Any]] = {}
+
+    def refresh(self) -> None:
+        if (stamp := stamp_paths((self.filepath, self.logpath))) == self.stamp:
+            return
+        self.items, self.entries = read_collection(self.filepath, self.logpath)
+        self.stamp = stamp
+        for hook in reload_hooks:
+            hook(self.filepath, list(self.items))
+
+    def apply(self, iid:str, status:bool) -> bool:
+        if status and iid not in self.items:
+            self.items[iid] = None
+        elif not status and iid in self.items:
+            del self.items[iid]
+        else:
+            return False
+        return True
+
+    def to_list(self) -> list[str]:
+        with self.lock:
+            self.refresh()
+            return list(self.items)
+
+    def contains(self, iid:str) -> bool:
+        with self.lock:
+            self.refresh()
+            return iid in self.items
+
+    # a value computed from the items, like the cover preview, kept until they change
+    def derive(self, key:str, function:Callable[[list[str]], Any]) -> Any:
+        with self.lock:
+            self.refresh()
+            if (cached := self.derived.get(key)) and cached[0] == self.stamp:
+                return cached[1]
+            value = function(list(self.items))
+            self.derived[key] = (self.stamp, value)
+            return value
+
+    def toggle(self, iid:str, status:bool) -> bool:
+        with self.lock:
+            self.refresh()
+            if not self.apply(iid, status):
+                return False
+            if self.entries >= COMPACT_ENTRIES or not os.path.exists(self.filepath):
+                self.compact()
+            else:
+                with open(self.logpath, "a", encoding="utf-8") as f:
+                    f.write(("+" if status else "-") + urllib.parse.quote(iid) + "\n")
+                self.entries += 1
+                self.stamp = stamp_paths((self.filepath, self.logpath))
+            return True
+
+    # rewrite the .ini file with the current items, keeping all its other fields, and drop the log
+    def compact(self, data:MetaDict|None=None) -> None:
+        if data == None:
+            try:
+                data = read_metadata_file(self.filepath)
+            except FileNotFoundError:
+                data = cast(MetaDict, {})
+        data = cast(MetaDict, {**data, "items": list(self.items)})
+        mkfiledir(self.filepath)
+        if Config.USE_BAK_FILES and os.path.isfile(self.filepath):
+            copyfile(self.filepath, f"{self.filepath}.bak")
+        # written aside and renamed into place, so that an interrupted compaction leaves the old file and the log as they were
+        temp_path = f"{self.filepath}.{os.getpid()}-{get_ident()}.tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            f.write(write_metadata(data))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, self.filepath)
+        if os.path.exists(self.logpath):
+            os.remove(self.logpath)
+        self.entries = 0
+        self.stamp = stamp_paths((self.filepath, self.logpath))
+
+    def flush(self) -> None:
+        with self.lock:
+            self.refresh()
+            if self.entries:
+                self.compact()
+
+    # for saving the whole .ini file, as for a user's profile, without losing the items logged since it was read
+    def save(self, data:MetaDict) -> None:
+        with self.lock:
+            self.refresh()
+            self.compact(data)
+
+collections_lock = Lock()
+collections: OrderedDict[str, CollectionItems] = OrderedDict()
+
+def collection_items(filepath:str) -> CollectionItems:
+    filepath = os.path.normpath(filepath)
+    with collections_lock:
+        if (collection := collections.get(filepath)):
+            collections.move_to_end(filepath)
+            return collection
+        collection = collections[filepath] = CollectionItems(filepath)
+        if len(collections) > MAX_COLLECTIONS:
+            # one still being worked on is skipped, so that a second copy of it can't be loaded meanwhile
+            for key in [key for key, old in collections.items() if not old.lock.locked()][:len(collections) - MAX_COLLECTIONS]:
+                del collections[key]
+        return collection
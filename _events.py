@@ -0,0 +1,285 @@
+import os
+import time
+import atexit
+import urllib.parse
+from heapq import merge
+from datetime import date, datetime
+from queue import Queue, Empty
+from threading import Thread, Condition, Lock
+from typing import Callable, Iterator
+from _pignio import EVENTS_ROOT, MODERATION_LIST, LISTS_EXT, METRICS, Config
+from _util import mkdirs, mkfiledir
+from _cache import LRUCache, stamp_paths
+from _app_factory import app
+
+TAIL_CHUNK = 16 * 1024
+# unread events are counted only up to this many, past which the exact number is not worth reading more of the history
+UNREAD_LIMIT = 100
+
+# a stream of events is its active `<name>.wsv` file, which gets appended to, plus the older segments sealed into the `<name>` folder,
+#  named so that they sort by time; lines in every file are in time order, so the newest events are always at the end of the stream
+def stream_segments(filepath:str) -> list[str]:
+    folder = filepath.removesuffix(LISTS_EXT)
+    try:
+        sealed = sorted((name for name in os.listdir(folder) if name.endswith(LISTS_EXT)), key=segment_order)
+    except (FileNotFoundError, NotADirectoryError):
+        sealed = []
+    return [os.path.join(folder, name) for name in sealed] + [filepath]
+
+# segments sealed within the same second get a `-NNN` suffix after the first, which would sort before it by name alone
+def segment_order(name:str) -> tuple[str, int]:
+    stamp, _, suffix = name.removesuffix(LISTS_EXT).partition("-")
+    return (stamp, int(suffix) if suffix.isdigit() else 0)
+
+def read_lines_reversed(filepath:str) -> Iterator[str]:
+    try:
+        f = open(filepath, "rb")
+    except FileNotFoundError:
+        return
+    with f:
+        position = f.seek(0, os.SEEK_END)
+        rest = b""
+        while position > 0:
+            start = max(0, position - TAIL_CHUNK)
+            f.seek(start)
+            lines = (f.read(position - start) + rest).split(b"\n")
+            position = start
+            rest = (lines.pop(0) if position > 0 else b"")
+            for line in reversed(lines):
+                for token in reversed(line.split()):
+                    yield urllib.parse.unquote(token.decode(errors="replace"))
+
+def event_time(line:str) -> float:
+    return float(line.split(":", 1)[0].split("@", 1)[1])
+
+class EventStore:
+    def __init__(self):
+        self.unread_cache = LRUCache("Unread Events", 1000, recheck_seconds=2)
+        self.pages = self.lines = 0
+
+    def user_stream(self, username:str) -> str:
+        return os.path.join(EVENTS_ROOT, username + LISTS_EXT)
+
+    def cursor_path(self, username:str) -> str:
+        return os.path.join(EVENTS_ROOT, username + ".cursor")
+
+    def streams(self, username:str, is_admin:bool=False) -> list[str]:
+        return [self.user_stream(username)] + ([MODERATION_LIST] if is_admin else [])
+
+    def tail(self, filepath:str) -> Iterator[tuple[float, str]]:
+        for segment in reversed(stream_segments(filepath)):
+            for line in read_lines_reversed(segment):
+                try:
+                    time = event_time(line)
+                except (IndexError, ValueError):
+                    continue
+                self.lines += 1
+                yield (time, line)
+
+    # newest first, reading the streams only as far back as the caller consumes
+    def iterate(self, username:str, is_admin:bool=False) -> Iterator[tuple[float, str]]:
+        self.pages += 1
+        return merge(*[self.tail(filepath) for filepath in self.streams(username, is_admin)], key=(lambda event: event[0]), reverse=True)
+
+    def get_cursor(self, username:str) -> float:
+        try:
+            with open(self.cursor_path(username), "r") as f:
+                return float(f.read().strip() or 0)
+        except (FileNotFoundError, ValueError):
+            return 0
+
+    def mark_read(self, username:str, is_admin:bool=False) -> None:
+        if (newest := next(self.iterate(username, is_admin), None)) and newest[0] > self.get_cursor(username):
+            mkdirs(EVENTS_ROOT)
+            with open(self.cursor_path(username), "w") as f:
+                f.write(repr(newest[0]))
+        self.unread_cache.invalidate(username)
+
+    def unread(self, username:str, is_admin:bool=False) -> int:
+        if (count := self.unread_cache.get(username)) != None:
+            return count
+        paths = self.streams(username, is_admin) + [self.cursor_path(username)]
+        stamp = stamp_paths(tuple(paths))
+        cursor = self.get_cursor(username)
+        count = 0
+        for time, line in self.iterate(username, is_admin):
+            if time <= cursor or count >= UNREAD_LIMIT:
+                break
+            count += 1
+        self.unread_cache.put(username, count, paths, stamp=stamp)
+        return count
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "Pages read": self.pages,
+            "Lines parsed": self.lines,
+        }
+
+# every log has its own queue of pending lines, and one thread writes out whatever piled up in all of them at each flush interval,
+#  so that a burst of events costs one append (and at most one fsync) per log, instead of one per event
+class EventWriter:
+    def __init__(self):
+        self.pending: dict[str, list[str]] = {}
+        self.condition = Condition()
+        self.write_lock = Lock()
+        self.thread: Thread|None = None
+        self.stopping = False
+        self.batches = self.lines = self.fsyncs = self.rotations = self.errors = 0
+        self.batch_max = 0
+        self.latency_max = 0.0
+        self.oldest: float|None = None
+
+    def start(self) -> None:
+        if self.thread:
+            return
+        self.thread = Thread(target=self.run, daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    def append(self, filepath:str, line:str) -> None:
+        with self.condition:
+            self.pending.setdefault(filepath, []).append(line)
+            self.oldest = self.oldest or time.time()
+            synchronous = (not self.thread or self.stopping)
+        if synchronous:
+            self.flush()
+
+    def run(self) -> None:
+        while not self.stopping:
+            with self.condition:
+                self.condition.wait(Config.EVENTS_FLUSH_INTERVAL)
+            self.flush()
+
+    # writes everything still queued, for when the server is shutting down
+    def close(self) -> None:
+        with self.condition:
+            self.stopping = True
+            self.condition.notify()
+        self.flush()
+
+    # appends wait on the queue lock only for swapping out the pending lines, never for the disk
+    def flush(self) -> None:
+        with self.write_lock:
+            with self.condition:
+                pending, self.pending = self.pending, {}
+                if self.oldest:
+                    self.latency_max = max(self.latency_max, time.time() - self.oldest)
+                    self.oldest = None
+            for filepath, lines in pending.items():
+                try:
+                    self.write(filepath, lines)
+                    self.batches += 1
+                    self.lines += len(lines)
+                    self.batch_max = max(self.batch_max, len(lines))
+                except OSError:
+                    self.errors += 1
+                    app.logger.exception(f"Events writer error on {filepath}")
+
+    def write(self, filepath:str, lines:list[str]) -> None:
+        self.rotate(filepath)
+        mkfiledir(filepath)
+        with open(filepath, "a", encoding="utf-8") as f:
+            f.write("\n".join(lines) + "\n")
+            if Config.EVENTS_FSYNC == "batch":
+                f.flush()
+                os.fsync(f.fileno())
+                self.fsyncs += 1
+
+    # the active file is sealed into the segments folder once it grows past the configured size, or on the first write of a new day
+    def rotate(self, filepath:str) -> None:
+        try:
+            stat = os.stat(filepath)
+        except FileNotFoundError:
+            return
+        if not (stat.st_size >= Config.EVENTS_SEGMENT_KILOBYTES * 1024 or date.fromtimestamp(stat.st_mtime) != date.today()):
+            return
+        folder = filepath.removesuffix(LISTS_EXT)
+        name = datetime.fromtimestamp(stat.st_mtime).strftime("%Y%m%d%H%M%S")
+        mkdirs(folder)
+        sealed = os.path.join(folder, name + LISTS_EXT)
+        suffix = 0
+        while os.path.exists(sealed):
+            sealed = os.path.join(folder, f"{name}-{(suffix := suffix + 1):03}{LISTS_EXT}")
+        if Config.EVENTS_FSYNC != "never":
+            with open(filepath, "a") as f:
+                os.fsync(f.fileno())
+                self.fsyncs += 1
+        os.rename(filepath, sealed)
+        self.rotations += 1
+
+    def stats(self) -> dict[str, int|float]:
+        return {
+            "Queued logs": len(self.pending),
+            "Batches written": self.batches,
+            "Lines written": self.lines,
+            "Largest batch": self.batch_max,
+            "Max latency (s)": round(self.latency_max, 3),
+            "Fsyncs": self.fsyncs,
+            "Rotations": self.rotations,
+            "Errors": self.errors,
+        }
+
+# write paths only publish one event, and workers find out who should be notified of it and queue it into each of their logs
+class EventFanout:
+    def __init__(self, workers:int):
+        self.workers = workers
+        self.queue: Queue[tuple[str, str, str, str]] = Queue()
+        self.recipients: Callable[[str, str, str], set[str]]|None = None
+        self.started = False
+        self.published = self.delivered = self.errors = 0
+        self.lag_max = 0.0
+
+    def start(self) -> None:
+        if self.started:
+            return
+        self.started = True
+        for _ in range(self.workers):
+            Thread(target=self.run, daemon=True).start()
+        atexit.register(self.drain)
+
+    def publish(self, kind:str, iid:str, username:str, collection:str|None=None) -> None:
+        now = time.time()
+        self.queue.put((kind, iid, username, f"{kind}@{now}:{iid},{username}" + (f",{collection}" if collection != None else "")))
+        self.published += 1
+        if not self.started:
+            self.drain()
+
+    def run(self) -> None:
+        while True:
+            self.deliver(*self.queue.get())
+            self.queue.task_done()
+
+    def drain(self) -> None:
+        while True:
+            try:
+                event = self.queue.get_nowait()
+            except Empty:
+                return
+            self.deliver(*event)
+            self.queue.task_done()
+
+    def deliver(self, kind:str, iid:str, username:str, line:str) -> None:
+        try:
+            for recipient in (self.recipients(kind, iid, username) if self.recipients else set()) - {username}:
+                event_writer.append(event_store.user_stream(recipient), line)
+                self.delivered += 1
+            self.lag_max = max(self.lag_max, time.time() - event_time(line))
+        except Exception:
+            self.errors += 1
+            app.logger.exception(f"Events fan-out error on {line}")
+
+    def stats(self) -> dict[str, int|float]:
+        return {
+            "Queue depth": self.queue.qsize(),
+            "Events published": self.published,
+            "Notifications delivered": self.delivered,
+            "Max lag (s)": round(self.lag_max, 3),
+            "Errors": self.errors,
+        }
+
+event_store = EventStore()
+event_writer = EventWriter()
+event_fanout = EventFanout(Config.EVENTS_FANOUT_WORKERS)
+METRICS["Events"] = event_store.stats
+METRICS["Events Writer"] = event_writer.stats
+METRICS["Events Fan-out"] = event_fanout.stats
@@ -1,9 +1,11 @@
 import os
 import json
+import time
 import requests
 import urllib.parse
 from PIL import Image
-from typing import Any, Literal, List, AnyStr, cast
+from typing import Any, Literal, List, AnyStr, Iterator, Mapping, cast
+from types import MappingProxyType
 from base64 import b64decode, urlsafe_b64encode
 from urllib.parse import urlparse
 from io import StringIO
@@ -13,6 +15,7 @@ from glob import glob, escape as glob_escape
 from datetime import datetime
 from snowflake import Snowflake # type: ignore[import-untyped]
 from hashlib import sha256
+from random import getrandbits as randbits
 from shutil import copyfile
 from pytesseract import image_to_string, TesseractNotFoundError # type: ignore[import-untyped]
 from werkzeug.utils import safe_join
@@ -21,6 +24,18 @@ from _pignio import *
 from _functions import *
 from _media import *
 from _auth import *
+from _index import item_index, ORDERS
+from _users import user_cache
+from _app_factory import app
+from _cache import LRUCache, estimate_size, stamp_paths
+from _collection_log import CollectionItems, collection_items, read_collection, reload_hooks
+from _watcher import file_watcher
+from _events import event_fanout
+
+PREVIEW_ITEMS = 2
+
+item_cache = LRUCache("Items", Config.ITEM_CACHE_SIZE, Config.ITEM_CACHE_MEGABYTES * 1024 * 1024)
+collection_cache = LRUCache("Collections", Config.COLLECTION_CACHE_SIZE)
 
 def sort_items(items, key:str="datetime", inverse:bool=False):
     items = sorted(items, key=(lambda item: item.get(key, '0')))
@@ -29,61 +44,165 @@ def sort_items(items, key:str="datetime", inverse:bool=False):
     return items
 
 def walk_items(walk_path:str|None=None, only_ids:bool=False, creator:str|None=None, comments:bool=False) -> list:
-    results: dict[str, dict[str, ItemDict|None]] = {}
-
-    walk_root = ITEMS_ROOT
-    if walk_path:
-        walk_root += f"/{walk_path}"
-
-    for root, dirs, files in os.walk(walk_root):
+    return item_index.query(walk_path, only_ids, creator, comments)
+
+def iter_items(walk_path:str|None=None, creator:str|None=None, comments:bool=False, order:str="filename", after:list[str]|None=None, kind:str|None=None) -> Iterator[ItemDict]:
+    return item_index.iterate(walk_path, creator, comments, order, after, kind)
+
+def walk_comments(iid:str) -> list[ItemDict]:
+    return item_index.children(iid_to_filename(iid), "comment")
+
+# lazy source of indexed items, which can resume right after the sort key of a given item
+class ItemsCursor:
+    def __init__(self, walk_path:str|None=None, creator:str|None=None, comments:bool=False, order:str="filename", kind:str|None=None):
+        self.walk_path = walk_path
+        self.creator = creator
+        self.comments = comments
+        self.order = order
+        self.kind = kind
+
+    def __call__(self, after:list[str]|None=None) -> Iterator[ItemDict]:
+        # a cursor handed back by a client must have one value per key of the order, or it can't be compared in the query
+        if after and len(after) != len(ORDERS[self.order][0]):
+            return abort(400)
+        return iter_items(self.walk_path, self.creator, self.comments, self.order, after, self.kind)
+
+    def key(self, item:ItemDict) -> list[str]:
+        if self.order == "datetime":
+            return [item.get("datetime") or "", item["id"]]
+        return [iid_to_filename(item["id"])]
+
+def walk_item_files(walk_path:str|None=None) -> Iterator[tuple[str, str]]:
+    for root, dirs, files in os.walk(os.path.join(ITEMS_ROOT, walk_path) if walk_path else ITEMS_ROOT):
         rel_path = os.path.relpath(root, ITEMS_ROOT).replace(os.sep, "/")
         if rel_path == ".":
             rel_path = ""
-
-        results[rel_path] = {}
-
-        for file in files:
-            if check_file_supported(file):
-                iid = strip_ext(os.path.join(rel_path, file).replace(os.sep, "/"))
-                iid = filename_to_iid(iid)
-                results[rel_path][iid] = None
-
-        if not only_ids:
-            for iid in results[rel_path]:
-                is_comment = not (not (rel_rel_path := "/".join(rel_path.split("/")[:-1])) or (rel_rel_path not in results) or (filename_to_iid(rel_path) not in results[rel_rel_path]))
-                if (not comments and not is_comment) or (comments and is_comment):
-                    item = load_item(iid)
-                    if item and (not creator or item.get("creator") == creator):
-                        results[rel_path][iid] = item
-
-    output = [value for inner in results.values() for value in inner.values()]
-    return [item for item in output if item]
+        filenames = {strip_ext(os.path.join(rel_path, file).replace(os.sep, "/")) for file in files if check_file_supported(file)}
+        for filename in sorted(filenames):
+            yield (filename_to_iid(filename), filename)
+
+def rebuild_index() -> int:
+    count, touched = item_index.replace_all((item, filename, measure_item(iid)) for iid, filename in walk_item_files() if (item := load_item(iid)))
+    for iid in touched:
+        index_item(iid)
+    reconcile_counters(False)
+    return count
+
+def ensure_index() -> None:
+    if not item_index.is_current():
+        rebuild_index()
+
+def index_item(iid:str) -> ItemDict|None:
+    iid = filename_to_iid(iid)
+    item_cache.invalidate(iid)
+    if (item := load_item(iid)):
+        item_index.put(item, iid_to_filename(iid), measure_item(iid))
+    else:
+        item_index.remove(iid)
+    return item
+
+def sync_item_path(path:str, is_dir:bool) -> None:
+    if not path:
+        rebuild_index()
+        return
+    if is_dir:
+        for iid in item_index.iids_in(path):
+            index_item(iid)
+        for iid, filename in walk_item_files(path):
+            index_item(iid)
+    elif check_file_supported(path):
+        index_item(strip_ext(path))
+    # the change may also belong to a carousel, whose images are stored in a folder named like the item
+    if (parent := path if is_dir else "/".join(path.split("/")[:-1])) and item_index.get(filename_to_iid(parent)):
+        index_item(parent)
+
+# user files edited by hand are picked up right away, along with the API tokens in them
+def sync_user_path(path:str, is_dir:bool) -> None:
+    if not path:
+        reload_users()
+    elif not is_dir and "/" not in path and path.endswith(ITEMS_EXT):
+        user_cache.invalidate(os.path.join(USERS_ROOT, path))
+        token_registry.reload_user(strip_ext(path))
+
+def reload_users() -> None:
+    user_cache.clear()
+    token_registry.load()
+
+def measure_item(iid:str) -> int:
+    size = 0
+    for file in find_files_for_iid(iid):
+        try:
+            size += os.path.getsize(file)
+        except OSError:
+            pass
+    return size
 
 def count_items() -> int:
-    return len(walk_items(only_ids=True))
+    return item_index.counters().get("items", 0)
 
 def count_users() -> int:
-    return len(glob(f"{USERS_ROOT}/*.ini"))
-
-def walk_collections(username:str) -> dict:
+    return item_index.counters().get("users", 0)
+
+# users and collections are only counted up on the usual write paths, so everything (including pins) is periodically recounted from disk
+def reconcile_counters(items:bool=True) -> None:
+    if items:
+        item_index.recount()
+    item_index.set_counters({
+        "users": len(glob(f"{USERS_ROOT}/*{ITEMS_EXT}")),
+        "collections": len(glob(f"{USERS_ROOT}/*/**/*{ITEMS_EXT}", recursive=True)),
+    })
+    rebuild_pins()
+
+def count_by_prefix(counters:dict[str, int], prefix:str) -> dict[str, int]:
+    return {key.removeprefix(prefix): value for key, value in counters.items() if key.startswith(prefix)}
+
+def run_counters_reconciler() -> None:
+    while True:
+        try:
+            reconcile_counters()
+        except Exception:
+            app.logger.exception("Counters reconcile error")
+        time.sleep(Config.COUNTERS_INTERVAL)
+
+# collections are cached per user as read-only views, until any of their files changes on disk
+def walk_collections(username:str) -> Mapping[str, Mapping[str, Any]]:
+    if (cached := collection_cache.get(username)):
+        return cached
     results: dict[str, CollectionDict] = {}
-    filepath = USERS_ROOT
-
-    filepath = os.path.join(filepath, username)
-    data = cast(UserDict, read_metadata(read_textual(filepath + ITEMS_EXT)))
-    results[""] = load_collection(data)
-
-    for root, dirs, files in os.walk(filepath):
+    filepath = os.path.join(USERS_ROOT, username)
+    # every file and folder is stamped before it is read, so that one changed meanwhile leaves the cached view stale rather than hiding the change
+    paths: list[str] = []
+    stamp: list = []
+
+    def read_collection(cid:str, path:str) -> None:
+        collection = collection_items(path)
+        paths.extend((path, collection.logpath))
+        stamp.extend(stamp_paths((path, collection.logpath)))
+        data = cast(UserDict, read_metadata_file(path))
+        data["items"] = collection.to_list()
+        results[cid] = load_collection(data, collection)
+
+    read_collection("", filepath + ITEMS_EXT)
+    folders = [filepath]
+    while folders:
+        root = folders.pop(0)
+        paths.append(root)
+        stamp.extend(stamp_paths((root,)))
+        try:
+            names = sorted(os.listdir(root))
+        except (FileNotFoundError, NotADirectoryError):
+            continue
         rel_path = os.path.relpath(root, filepath).replace(os.sep, "/")
-        if rel_path == ".":
-            rel_path = ""
-        for file in files:
-            if check_file_is_meta(file):
-                cid = rel_path + strip_ext(file)
-                data = cast(UserDict, read_metadata(read_textual(os.path.join(filepath, file))))
-                results[cid] = load_collection(data)
+        rel_path = ("" if rel_path == "." else rel_path + "/")
+        for name in names:
+            if os.path.isdir(path := os.path.join(root, name)):
+                folders.append(path)
+            elif check_file_is_meta(name):
+                read_collection(rel_path + strip_ext(name), path)
 
-    return results
+    view = MappingProxyType({cid: MappingProxyType({key: (tuple(value) if type(value) == list else value) for key, value in data.items()}) for cid, data in results.items()})
+    collection_cache.put(username, view, paths, estimate_size(results), tuple(stamp))
+    return view
 
 def list_folders(path:str):
     folders = []
@@ -96,17 +215,45 @@ def list_folders(path:str):
 def make_folders(collections):
     folders = []
     for cid in collections:
-        items = list(filter(None, [load_item(iid) for iid in collections[cid]["items"]]))
+        items = list(filter(None, [load_item(iid) for iid in collections[cid]["preview"]]))
         if len(items) > 0:
-            folders.append({**collections[cid], "id": cid, "items": items[:2] + items[-2:]})
+            folders.append({**collections[cid], "id": cid, "items": items})
     return folders
 
+# the first and last few valid items of a collection, newest first, and how many valid items it has; recomputed only when the collection changes
+def make_collection_preview(iids:list[str]) -> tuple[tuple[str, ...], int]:
+    existing = item_index.existing(iids)
+    valid = [iid for iid in reversed(iids) if iid in existing]
+    preview = tuple(valid[:PREVIEW_ITEMS] + valid[-PREVIEW_ITEMS:])
+    warm_thumbs(list(filter(None, [load_item(iid) for iid in set(preview)])))
+    return (preview, len(valid))
+
+# random order over all the listable items, drawing only the ones in the requested slice; the same seed always gives the same order
+class RandomItems:
+    def __init__(self, walk_path:str|None=None, seed:str|None=None):
+        self.rowids = item_index.listable_rowids(walk_path)
+        try:
+            [self.seed, self.count] = [int(value) for value in (seed or "").split(".")]
+            if self.count < 0:
+                raise ValueError
+            self.count = min(self.count, len(self.rowids))
+        except ValueError:
+            self.seed = randbits(32)
+            self.count = len(self.rowids)
+
+    def token(self) -> str:
+        return f"{self.seed}.{self.count}"
+
+    def __getitem__(self, bounds:slice) -> list[ItemDict]:
+        positions = range(*bounds.indices(self.count))
+        return item_index.get_rows([self.rowids[permute_index(position, self.count, self.seed)] for position in positions])
+
 def has_subitems_directory(iid:str) -> str|Literal[False]:
     return dirpath if ((dirpath := safe_join(ITEMS_ROOT, iid)) and os.path.isdir(dirpath)) else False # TODO also check if folder is not empty?
 
 def is_items_folder(path:str) -> str|Literal[False]:
     if (dirpath := has_subitems_directory(path)):
-        if len([item for item in [x for x in walk_items(path) if x] if item.get("type") != "comment"]) > 0:
+        if any(item.get("type") != "comment" for item in iter_items(path)):
             return dirpath
     return False
 
@@ -135,12 +282,16 @@ def find_files_for_iid(iid:str, prefix_root:bool=True) -> List[AnyStr]:
 
 def load_item(iid:str) -> ItemDict|None:
     iid = filename_to_iid(iid)
+    if (cached := item_cache.get(iid)):
+        return copy_item(cached)
     filename = iid_to_filename(iid)
     filepath = safe_join(ITEMS_ROOT, filename)
     if not filepath:
         return None
 
     files = find_files_for_iid(filepath, False)
+    # taken before reading, with the folder of a carousel at the end, which is only kept if the item turns out to be one
+    stamp = stamp_paths((*files, filepath))
     if len(files):
         # data = Item({"id": iid})
         data: ItemDict = {"id": iid}
@@ -150,7 +301,7 @@ def load_item(iid:str) -> ItemDict|None:
         filesdata = {}
         for file in files:
             if check_file_is_meta(file):
-                data = data | read_metadata(read_textual(file))
+                data = data | read_metadata_file(file)
             elif (kind := check_file_is_content(file)):
                 filesdata[kind] = file.replace(os.sep, "/").removeprefix(f"{ITEMS_ROOT}/")
         data = data | cast(ItemDict, filesdata)
@@ -171,11 +322,16 @@ def load_item(iid:str) -> ItemDict|None:
                         data["images"].append(mediapath)
             if fromfiles:
                 data["images"] = sorted(data["images"])
+            files.append(filepath)
 
         if len(data) > 1: # prevent empty ini files with no valid media from being returned
+            item_cache.put(iid, copy_item(data), files, estimate_size(data), stamp[:len(files)])
             return data
     return None
 
+def copy_item(item:ItemDict) -> ItemDict:
+    return cast(ItemDict, {key: (list(value) if type(value) == list else value) for key, value in item.items()})
+
 # TODO: when updating existing item, and providing new media in the request, first delete old ones to account for different extensions; also clean cache every time
 def store_item(iid:str, data:dict[str, str], files:dict|None=None, ocr:bool=False, *, comment:bool=False) -> bool:
     iid = filename_to_iid(iid)
@@ -266,6 +422,11 @@ def store_item(iid:str, data:dict[str, str], files:dict|None=None, ocr:bool=Fals
 
     write_textual(filepath + ITEMS_EXT, write_metadata(data))
     delete_item_cache(iid)
+    index_item(iid)
+    if not comment and (item := load_item(iid)):
+        warm_thumbs([item])
+    if comment and not existing:
+        event_fanout.publish("comment", filename_to_iid(filename[0]), data["creator"])
     return True
 
 def delete_item(item:dict|str, only_media:bool=False) -> int:
@@ -276,6 +437,7 @@ def delete_item(item:dict|str, only_media:bool=False) -> int:
             if not only_media or not file.lower().endswith(ITEMS_EXT):
                 os.remove(file)
                 deleted += 1
+        index_item(ensure_item_id(item))
     return deleted + delete_item_cache(item)
 
 def delete_item_cache(item:dict|str) -> int:
@@ -300,26 +462,44 @@ def ensure_item_dict(data:ItemDict|str) -> ItemDict:
 
 def toggle_in_collection(username:str, cid:str, iid:str, status:bool) -> None:
     filepath = get_collection_filepath(username, cid)
-    try:
-        data = cast(CollectionDict, read_metadata(read_textual(filepath)))
-    except FileNotFoundError:
-        data = cast(CollectionDict, {})
-    if not "items" in data:
-        data["items"] = []
-    if status:
-        data["items"].append(iid)
-    else:
-        data["items"].remove(iid)
-    mkdirs("/".join(filepath.split("/")[:-1]))
-    write_textual(filepath, write_metadata(data))
+    if cid and status and not os.path.exists(filepath):
+        item_index.bump("collections")
+    changed = collection_items(filepath).toggle(iid, status)
+    collection_cache.invalidate(username)
+    item_index.pin(username, cid, iid, status)
+    if changed and status:
+        event_fanout.publish("pin", iid, username, cid)
+
+# the creator of an item hears of pins and comments on it, and everyone who commented on it hears of further comments
+def event_recipients(kind:str, iid:str, username:str) -> set[str]:
+    recipients = set()
+    if (item := load_item(iid)) and (creator := item.get("creator")):
+        recipients.add(creator)
+    if kind == "comment":
+        recipients |= {creator for comment in walk_comments(iid) if (creator := comment.get("creator"))}
+    return {recipient for recipient in recipients if os.path.isfile(get_collection_filepath(recipient, ""))}
 
 def get_collection_filepath(username:str, cid:str) -> str:
     return f"{USERS_ROOT}/{username}" + (f"/{cid}" if cid else "") + ITEMS_EXT
 
-def load_collection(data:UserDict) -> CollectionDict:
-    items = data.get("items", [])
-    items.reverse()
-    return cast(CollectionDict, {**data, "items": items})
+def split_collection_filepath(filepath:str) -> tuple[str, str]:
+    [username, *cid] = strip_ext(os.path.relpath(filepath, USERS_ROOT).replace(os.sep, "/")).split("/")
+    return (username, "/".join(cid))
+
+def sync_collection_pins(filepath:str, iids:list[str]) -> None:
+    item_index.set_pins(*split_collection_filepath(filepath), iids)
+
+def rebuild_pins() -> None:
+    pins = []
+    for filepath in glob(f"{USERS_ROOT}/*{ITEMS_EXT}") + glob(f"{USERS_ROOT}/*/**/*{ITEMS_EXT}", recursive=True):
+        username, cid = split_collection_filepath(filepath)
+        # read straight from disk, since loading every collection into the registry would run its reload hooks and push out the ones in use
+        pins += [(iid, username, cid) for iid in read_collection(filepath)[0]]
+    item_index.replace_pins(pins)
+
+def load_collection(data:UserDict, collection:CollectionItems|None=None) -> CollectionDict:
+    preview, count = (collection.derive("preview", make_collection_preview) if collection else ((), 0))
+    return cast(CollectionDict, {**data, "items": data.get("items", [])[::-1], "preview": preview, "count": count})
 
 def fetch_url_data(url:str) -> dict[str, str|None]:
     response = requests.get(url, timeout=5)
@@ -401,3 +581,9 @@ def view_embedded(iid:str, template:str, key:str, kwarger:Callable|None=None):
         return render_template(f"embeds/{template}.html", **{key: media}, **kwargs)
     else:
         return abort(404)
+
+METRICS["Counters"] = item_index.counters
+reload_hooks.append(sync_collection_pins)
+event_fanout.recipients = event_recipients
+file_watcher.register(ITEMS_ROOT, sync_item_path, rebuild_index)
+file_watcher.register(USERS_ROOT, sync_user_path, reload_users)
@@ -7,8 +7,8 @@ from io import BytesIO
 from zipstream import ZipFile, ZIP_DEFLATED # type: ignore[import-untyped]
 from bs4 import BeautifulSoup # type: ignore[import-untyped]
 from functools import wraps
-from typing import Callable, Any, Literal, cast
-from base64 import b64decode, urlsafe_b64encode
+from typing import Callable, Any, Literal, Iterator, cast
+from base64 import b64decode, urlsafe_b64encode, urlsafe_b64decode
 from hashlib import sha256
 from slugify import slugify
 from jinja2 import Undefined
@@ -20,20 +20,13 @@ from _util import *
 from _pignio import *
 from _media import check_ffmpeg_available
 from _users import User, RemoteUser
+from _events import event_store
 
-def load_events(user:User) -> list[dict[str,str]]:
-    events = []
-    try:
-        sources = wsv_to_list(read_textual(os.path.join(EVENTS_ROOT, user.username + LISTS_EXT)))
-    except FileNotFoundError:
-        sources = []
-    if user.is_admin:
-        sources += wsv_to_list(read_textual(MODERATION_LIST))
-    for event in sources:
-        events.append(parse_event(event))
-    events = sorted(events, key=(lambda event: event["datetime"]))
-    events.reverse()
-    return events
+# newest first, only parsing as many events as get consumed
+def load_events(user:User) -> Iterator[dict[str,Any]]:
+    cursor = event_store.get_cursor(user.username)
+    for time, text in event_store.iterate(user.username, user.is_admin):
+        yield parse_event(text) | {"unread": time > cursor}
 
 def parse_event(text:str) -> dict[str,str]:
     [base, extra] = text.split(":")
@@ -72,6 +65,20 @@ def query_params(*param_names):
         return wrapper
     return decorator
 
+def encode_cursor(key:list[str]) -> str:
+    return urlsafe_b64encode(json.dumps(key).encode()).decode().rstrip("=")
+
+def decode_cursor(text:str|None) -> list[str]|None:
+    if not text:
+        return None
+    try:
+        key = json.loads(urlsafe_b64decode(text + "=" * (-len(text) % 4)))
+    except ValueError:
+        key = None
+    if type(key) != list or not all(type(value) == str for value in key):
+        return abort(400)
+    return key
+
 def response_with_type(content, mime):
     response = make_response(content)
     response.headers["Content-Type"] = mime
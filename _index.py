@@ -0,0 +1,350 @@
+import re
+import json
+import time
+import sqlite3
+from array import array
+from threading import local, Lock, Thread
+from typing import Iterable, Iterator, cast
+from _pignio import ItemDict, INDEX_DB, MEDIA_TYPES
+from _util import mkfiledir
+
+INDEX_VERSION = 5
+
+SEARCH_FIELDS = ("title", "description", "text", "alttext", "link", "creator")
+SEARCH_WEIGHTS = (10.0, 4.0, 2.0, 1.0, 1.0, 2.0)
+TAG_FIELDS = ("langs", "systags")
+
+SCHEMA = f"""
+CREATE TABLE IF NOT EXISTS items (
+    iid TEXT PRIMARY KEY,
+    filename TEXT NOT NULL,
+    dir TEXT NOT NULL,
+    creator TEXT,
+    kind TEXT,
+    datetime TEXT,
+    media TEXT,
+    bytes INTEGER NOT NULL DEFAULT 0,
+    comment INTEGER NOT NULL DEFAULT 0,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS items_filename ON items(filename);
+CREATE INDEX IF NOT EXISTS items_dir ON items(dir, kind, filename);
+CREATE INDEX IF NOT EXISTS items_creator ON items(creator, coalesce(datetime, ''), iid);
+CREATE INDEX IF NOT EXISTS items_creator_comments ON items(creator, coalesce(datetime, ''), iid) WHERE kind = 'comment';
+CREATE VIRTUAL TABLE IF NOT EXISTS search USING fts5({', '.join(SEARCH_FIELDS)}, tokenize="unicode61 remove_diacritics 2", prefix="2 3");
+CREATE TABLE IF NOT EXISTS tags (
+    item INTEGER NOT NULL,
+    key TEXT NOT NULL,
+    value TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS tags_item ON tags(item);
+CREATE INDEX IF NOT EXISTS tags_value ON tags(key, value, item);
+CREATE TABLE IF NOT EXISTS pins (
+    iid TEXT NOT NULL,
+    username TEXT NOT NULL,
+    cid TEXT NOT NULL,
+    PRIMARY KEY (iid, username, cid)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS pins_collection ON pins(username, cid);
+CREATE TABLE IF NOT EXISTS counters (
+    key TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+"""
+TABLES = ("items", "search", "tags")
+# counters about things other than items, which the index cannot recount by itself
+EXTERNAL_COUNTERS = ("users", "collections")
+LISTABLE_REFRESH_SECONDS = 10
+
+# sort keys for keyset pagination, each ending with a unique column so that cursors are unambiguous
+ORDERS = {
+    "filename": (("items.filename",), ""),
+    "datetime": (("coalesce(items.datetime, '')", "items.iid"), " DESC"),
+    # insertion order, which new items only ever append to
+    "rowid": (("items.rowid",), ""),
+}
+
+# an item is a comment (or a carousel sub-image) when its directory is itself an item, unless that parent is outside the walked subtree
+IS_COMMENT = "(items.dir != :root AND instr(items.dir, '/') > 0 AND EXISTS (SELECT 1 FROM items AS parent WHERE parent.filename = items.dir))"
+
+class ItemIndex:
+    def __init__(self, path:str):
+        self.path = path
+        self.local = local()
+        self.lock = Lock()
+        self.generation = 0
+        self.revision = 0
+        self.listable: tuple[int, float, array] = (-1, 0, array("q"))
+        self.refreshing = False
+        self.refresh_lock = Lock()
+        self.rebuild_lock = Lock()
+        self.touched: set[str]|None = None
+
+    def connect(self) -> sqlite3.Connection:
+        if getattr(self.local, "generation", None) != self.generation:
+            if (old := getattr(self.local, "connection", None)):
+                old.close()
+            mkfiledir(self.path)
+            connection = sqlite3.connect(self.path, timeout=30)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.executescript(SCHEMA)
+            self.local.connection = connection
+            self.local.generation = self.generation
+        return self.local.connection
+
+    # forget all open connections, for when the database file was removed from disk
+    def reset(self) -> None:
+        with self.lock:
+            self.generation += 1
+
+    def is_current(self) -> bool:
+        return self.connect().execute("PRAGMA user_version").fetchone()[0] == INDEX_VERSION
+
+    def insert(self, connection:sqlite3.Connection, item:ItemDict, filename:str, size:int=0, tally:bool=True) -> None:
+        # an edited item keeps its rowid, so that positions in the random feed stay stable
+        rowid = self.delete(connection, item["id"], tally)
+        folder = "/".join(filename.split("/")[:-1])
+        media = next((kind for kind in MEDIA_TYPES if item.get(kind)), None)
+        # the comment flag is only a best guess while items come in one by one, since the parent might get indexed later; recount() settles it
+        comment = ("/" in folder and connection.execute("SELECT 1 FROM items WHERE filename = ?", (folder,)).fetchone() != None)
+        rowid = connection.execute("INSERT INTO items (rowid, iid, filename, dir, creator, kind, datetime, media, bytes, comment, data) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", (rowid, item["id"], filename, folder, item.get("creator"), item.get("type"), item.get("datetime"), media, size, comment, json.dumps(item))).lastrowid
+        connection.execute(f"INSERT INTO search (rowid, {', '.join(SEARCH_FIELDS)}) VALUES (?{', ?' * len(SEARCH_FIELDS)})", (rowid, *[str(item.get(field) or "") for field in SEARCH_FIELDS]))
+        connection.executemany("INSERT INTO tags VALUES (?, ?, ?)", [(rowid, key, value) for key in TAG_FIELDS for value in set(cast(list[str], item.get(key) or []))])
+        if tally:
+            self.bump_many(connection, count_row(comment, item.get("type"), media, size))
+
+    def delete(self, connection:sqlite3.Connection, iid:str, tally:bool=True) -> int|None:
+        if (row := connection.execute("SELECT rowid, comment, kind, media, bytes FROM items WHERE iid = ?", (iid,)).fetchone()):
+            rowid = row[0]
+            connection.execute("DELETE FROM search WHERE rowid = ?", (rowid,))
+            connection.execute("DELETE FROM tags WHERE item = ?", (rowid,))
+            connection.execute("DELETE FROM items WHERE rowid = ?", (rowid,))
+            if tally:
+                self.bump_many(connection, {key: -value for key, value in count_row(*row[1:]).items()})
+            return rowid
+        return None
+
+    def put(self, item:ItemDict, filename:str, size:int=0) -> None:
+        with self.lock, (connection := self.connect()):
+            self.insert(connection, item, filename, size)
+            self.revision += 1
+            if self.touched != None:
+                self.touched.add(item["id"])
+
+    def remove(self, iid:str) -> None:
+        with self.lock, (connection := self.connect()):
+            self.delete(connection, iid)
+            self.revision += 1
+            if self.touched != None:
+                self.touched.add(iid)
+
+    # the entries are all read before taking the lock, so that other writes aren't held up for as long as it takes to walk the files; the items
+    #  written meanwhile are returned, since what was read for them might be older than what they wrote, and they should be indexed again
+    def replace_all(self, entries:Iterable[tuple[ItemDict, str, int]]) -> tuple[int, set[str]]:
+        with self.rebuild_lock:
+            with self.lock:
+                self.touched = set()
+            try:
+                count = self.write_all(list(entries))
+            finally:
+                with self.lock:
+                    touched, self.touched = (self.touched or set()), None
+            return count, touched
+
+    def write_all(self, entries:list[tuple[ItemDict, str, int]]) -> int:
+        count = 0
+        with self.lock, (connection := self.connect()):
+            # a single transaction, so that readers keep seeing the old index until the new one is complete
+            connection.execute("BEGIN")
+            for table in TABLES:
+                connection.execute(f"DROP TABLE IF EXISTS {table}")
+            for statement in SCHEMA.split(";"):
+                connection.execute(statement)
+            for item, filename, size in entries:
+                self.insert(connection, item, filename, size, False)
+                count += 1
+            self.recount(connection)
+            connection.execute(f"PRAGMA user_version = {INDEX_VERSION}")
+            self.revision += 1
+            # every rowid changed, so the random feed can only start over
+            self.listable = (-1, 0, array("q"))
+        return count
+
+    # recompute the item counters from scratch, to correct any drift of the ones kept up to date on writes
+    def recount(self, connection:sqlite3.Connection|None=None) -> None:
+        if not connection:
+            with self.lock, (connection := self.connect()):
+                return self.recount(connection)
+        connection.execute(f"UPDATE items SET comment = {IS_COMMENT}", {"root": ""})
+        connection.execute(f"DELETE FROM counters WHERE key NOT IN ({', '.join('?' * len(EXTERNAL_COUNTERS))})", EXTERNAL_COUNTERS)
+        counters: dict[str, int] = {}
+        for row in connection.execute("SELECT comment, kind, media, sum(bytes), count(*) FROM items GROUP BY comment, kind, media"):
+            for key, value in count_row(*row[:4]).items():
+                counters[key] = counters.get(key, 0) + (value if key == "bytes" else row[4])
+        self.bump_many(connection, counters)
+
+    def bump_many(self, connection:sqlite3.Connection, counters:dict[str, int]) -> None:
+        connection.executemany("INSERT INTO counters VALUES (?, ?) ON CONFLICT (key) DO UPDATE SET value = value + excluded.value", counters.items())
+
+    def bump(self, key:str, value:int=1) -> None:
+        with self.lock, (connection := self.connect()):
+            self.bump_many(connection, {key: value})
+
+    def set_counters(self, counters:dict[str, int]) -> None:
+        with self.lock, (connection := self.connect()):
+            connection.executemany("INSERT OR REPLACE INTO counters VALUES (?, ?)", counters.items())
+
+    def counters(self) -> dict[str, int]:
+        return dict(self.connect().execute("SELECT key, value FROM counters ORDER BY key").fetchall())
+
+    def get(self, iid:str) -> ItemDict|None:
+        row = self.connect().execute("SELECT data FROM items WHERE iid = ?", (iid,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def select(self, columns:str, root:str|None=None, creator:str|None=None, comments:bool=False, order:str="filename", after:list[str]|None=None, kind:str|None=None) -> sqlite3.Cursor:
+        root = (root or "").strip("/")
+        where = [(IS_COMMENT if comments else f"NOT {IS_COMMENT}")]
+        params: dict[str, str] = {"root": root}
+        keys, direction = ORDERS[order]
+        if root:
+            where.append("(items.dir = :root OR (items.dir > :root || '/' AND items.dir < :root || '0'))")
+        if creator:
+            where.append("items.creator = :creator")
+            params["creator"] = creator
+        if kind:
+            where.append("items.kind = :kind")
+            params["kind"] = kind
+        if after:
+            where.append(f"({', '.join(keys)}) {'<' if direction else '>'} ({', '.join(self.bind(after[:len(keys)], 'after', params))})")
+            # the same bound on the first key alone, which SQLite can seek to in an index even when that key is an expression
+            where.append(f"{keys[0]} {'<=' if direction else '>='} :after_0")
+        return self.connect().execute(f"SELECT {columns} FROM items WHERE {' AND '.join(where)} ORDER BY {', '.join(key + direction for key in keys)}", params)
+
+    def query(self, root:str|None=None, only_ids:bool=False, creator:str|None=None, comments:bool=False) -> list:
+        if only_ids:
+            return [row[0] for row in self.select("items.iid", root, creator, comments)]
+        return list(self.iterate(root, creator, comments))
+
+    def iterate(self, root:str|None=None, creator:str|None=None, comments:bool=False, order:str="filename", after:list[str]|None=None, kind:str|None=None) -> Iterator[ItemDict]:
+        for row in self.select("items.data", root, creator, comments, order, after, kind):
+            yield json.loads(row[0])
+
+    # the items of a given type stored right inside an item's folder, like its comments
+    def children(self, filename:str, kind:str) -> list[ItemDict]:
+        return [json.loads(row[0]) for row in self.connect().execute("SELECT data FROM items WHERE dir = ? AND kind = ? ORDER BY filename", (filename, kind))]
+
+    def search(self, query:str, field:str="", cased:bool=False, langs:list[str]=[], creators:list[str]=[], provenance:str|None=None, nsfw:bool|None=None) -> Iterator[ItemDict]:
+        where = [f"NOT {IS_COMMENT}"]
+        params: dict[str, str] = {"root": ""}
+        tokens = re.findall(r"\w+", query.lower())
+        if field == "id":
+            where.append("items.iid LIKE :like ESCAPE '\\'")
+            params["like"] = "%" + re.sub(r"([%_\\])", r"\\\1", query) + "%"
+        elif tokens:
+            if field and field not in SEARCH_FIELDS:
+                return iter([])
+            match = " AND ".join(f'"{token}"*' for token in tokens)
+            where.append("search MATCH :match")
+            params["match"] = (f"{field} : ({match})" if field else match)
+        if langs:
+            where.append(self.tag_filter("langs", langs, "langs", params))
+        if creators:
+            where.append(f"items.creator IN ({', '.join(self.bind(creators, 'creator', params))})")
+        if provenance:
+            where.append(self.tag_filter("systags", [provenance], "provenance", params))
+        if nsfw != None:
+            where.append(("" if nsfw else "NOT ") + self.tag_filter("systags", ["nsfw"], "nsfw", params))
+        order = (f"bm25(search, {', '.join(map(str, SEARCH_WEIGHTS))})" if "match" in params else "items.filename")
+        results = (json.loads(row[0]) for row in self.connect().execute(f"SELECT items.data FROM items JOIN search ON search.rowid = items.rowid WHERE {' AND '.join(where)} ORDER BY {order}", params))
+        # postings are case-insensitive, so an exact case match is checked only on the candidates
+        if cased and query:
+            results = (item for item in results if any(query in (value if type(value) == str else " ".join(value)) for key in ([field] if field else ["id", *SEARCH_FIELDS]) if (value := item.get(key))))
+        return results
+
+    def tag_filter(self, key:str, values:list[str], name:str, params:dict[str, str]) -> str:
+        params[f"{name}_key"] = key
+        return f"EXISTS (SELECT 1 FROM tags WHERE tags.item = items.rowid AND tags.key = :{name}_key AND tags.value IN ({', '.join(self.bind(values, name, params))}))"
+
+    def bind(self, values:list[str], prefix:str, params:dict[str, str]) -> list[str]:
+        names = []
+        for n, value in enumerate(values):
+            params[name := f"{prefix}_{n}"] = value
+            names.append(f":{name}")
+        return names
+
+    # rowids of all the items that can be listed, in insertion order, as a compact array to draw random samples from; the one for the whole library
+    #  is refreshed in the background, at most every few seconds, and only ever grows, so that positions in a feed being paged through stay put
+    def listable_rowids(self, root:str|None=None) -> array:
+        if root:
+            return array("q", [row[0] for row in self.select("items.rowid", root, order="rowid")])
+        revision, updated, rowids = self.listable
+        if revision < 0:
+            self.refresh_listable()
+        elif revision != self.revision and time.time() - updated > LISTABLE_REFRESH_SECONDS:
+            with self.refresh_lock:
+                if self.refreshing:
+                    return rowids
+                self.refreshing = True
+            Thread(target=self.refresh_listable, daemon=True).start()
+        return self.listable[2]
+
+    # new items are appended, while removed ones are left in place as gaps that get_rows() skips, until they make up half of the array and it is compacted
+    def refresh_listable(self) -> None:
+        try:
+            revision, rowids = self.revision, self.listable[2]
+            current = array("q", [row[0] for row in self.select("items.rowid", order="rowid")])
+            if rowids and len(current) * 2 > len(rowids):
+                last = rowids[-1]
+                rowids = rowids + array("q", [rowid for rowid in current if rowid > last])
+            else:
+                rowids = current
+            self.listable = (revision, time.time(), rowids)
+        finally:
+            with self.refresh_lock:
+                self.refreshing = False
+
+    def get_rows(self, rowids:list[int]) -> list[ItemDict]:
+        rows = dict(self.connect().execute(f"SELECT rowid, data FROM items WHERE rowid IN ({', '.join('?' * len(rowids))})", rowids).fetchall())
+        return [json.loads(rows[rowid]) for rowid in rowids if rowid in rows]
+
+    def existing(self, iids:list[str]) -> set[str]:
+        return {row[0] for row in self.connect().execute("SELECT items.iid FROM json_each(?) JOIN items ON items.iid = json_each.value", (json.dumps(iids),))}
+
+    # which collections of which users contain which items, mirroring the collection files
+    def pin(self, username:str, cid:str, iid:str, status:bool) -> None:
+        with self.lock, (connection := self.connect()):
+            connection.execute(("INSERT OR IGNORE INTO pins VALUES (?, ?, ?)" if status else "DELETE FROM pins WHERE iid = ? AND username = ? AND cid = ?"), (iid, username, cid))
+
+    def set_pins(self, username:str, cid:str, iids:Iterable[str]) -> None:
+        with self.lock, (connection := self.connect()):
+            connection.execute("DELETE FROM pins WHERE username = ? AND cid = ?", (username, cid))
+            connection.executemany("INSERT OR IGNORE INTO pins VALUES (?, ?, ?)", [(iid, username, cid) for iid in iids])
+
+    def replace_pins(self, pins:Iterable[tuple[str, str, str]]) -> None:
+        with self.lock, (connection := self.connect()):
+            connection.execute("DELETE FROM pins")
+            connection.executemany("INSERT OR IGNORE INTO pins VALUES (?, ?, ?)", pins)
+
+    def pinned_in(self, username:str, iid:str) -> set[str]:
+        return {row[0] for row in self.connect().execute("SELECT cid FROM pins WHERE iid = ? AND username = ?", (iid, username))}
+
+    def count_savers(self, iid:str) -> int:
+        return self.connect().execute("SELECT COUNT(DISTINCT username) FROM pins WHERE iid = ?", (iid,)).fetchone()[0]
+
+    def iids_in(self, root:str) -> list[str]:
+        return [row[0] for row in self.connect().execute("SELECT iid FROM items WHERE filename > :root || '/' AND filename < :root || '0'", {"root": root.strip("/")})]
+
+# counters a single indexed row contributes to; comments and carousel images are not items of their own
+def count_row(comment:bool, kind:str|None, media:str|None, size:int) -> dict[str, int]:
+    counters = {"bytes": size}
+    if kind == "comment":
+        counters["comments"] = 1
+    if not comment:
+        counters["items"] = 1
+        counters[f"type:{kind or 'item'}"] = 1
+        if media:
+            counters[f"media:{media}"] = 1
+    return counters
+
+item_index = ItemIndex(INDEX_DB)
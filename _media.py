@@ -2,15 +2,21 @@ import os
 import time
 import requests
 import ffmpeg # type: ignore[import-untyped]
-from PIL import Image, ImageFile
+from PIL import Image, ImageOps, ExifTags
 from io import BytesIO
-from flask import send_file
+from flask import request, send_file, Response
 from pytesseract import image_to_string, TesseractError, TesseractNotFoundError # type: ignore[import-untyped]
 from base64 import b64decode
-from typing import Literal, Callable, cast
+from typing import Literal, Callable, Any, Iterable, Iterator, cast
 from werkzeug.utils import safe_join
-from _pignio import ItemDict, ITEMS_ROOT, TEMP_ROOT, ITEMS_EXT, MEDIA_TYPES, PROXY_ROOT, EXTENSIONS, Config
+from queue import Queue
+from threading import Thread, Lock, BoundedSemaphore, get_ident
+from concurrent.futures import ProcessPoolExecutor, Future
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import get_context
+from _pignio import ItemDict, ITEMS_ROOT, TEMP_ROOT, ITEMS_EXT, MEDIA_TYPES, PROXY_ROOT, THUMBS_ROOT, EXTENSIONS, Config, METRICS
 from _util import read_textual, write_textual, mkfiledir, parse_absolute_url
+from _app_factory import app
 
 def check_file_supported(filename:str) -> bool:
     return check_file_is_meta(filename) or bool(check_file_is_content(filename))
@@ -67,33 +73,90 @@ def resolve_media(item:ItemDict, field:str):
     if not url:
         return None
 
-    data, mime = fetch_proxy_media(item["id"], url)
-    return BytesIO(data), mime
+    return fetch_proxy_media(item["id"], url)
 
-def fetch_proxy_media(iid:str, url:str, n:int=0) -> tuple[bytes, str]:
+PROXY_CHUNK = 64 * 1024
+proxy_stats = {"Cache hits": 0, "Streamed": 0, "Ranges passed through": 0, "Stored": 0, "Aborted": 0}
+METRICS["Proxy"] = (lambda: dict(proxy_stats))
+
+def get_proxy_paths(iid:str, n:int=0) -> tuple[str, str]:
     if n:
         iid += f"/{n}"
-    metapath = os.path.join(PROXY_ROOT, f"{iid}.inf")
+    return os.path.join(PROXY_ROOT, iid), os.path.join(PROXY_ROOT, f"{iid}.inf")
 
+# the cached copy of remote media, with its type, if it was completely downloaded
+def read_proxy_cache(iid:str, n:int=0) -> tuple[str, str]|None:
+    base, metapath = get_proxy_paths(iid, n)
     if Config.PROXY_CACHE and os.path.exists(metapath):
         kind, ext = read_textual(metapath).split("/")
-        path = os.path.join(PROXY_ROOT, f"{iid}.{ext}")
-        if os.path.exists(path):
-            with open(path, "rb") as f:
-                return f.read(), f"{kind}/{ext}"
+        if os.path.exists(path := f"{base}.{ext}"):
+            return path, f"{kind}/{ext}"
+    return None
+
+# passes the remote body on in chunks while writing it aside, and only a complete download is renamed into the cache;
+#  if the client goes away or the transfer breaks, the partial file is dropped
+def tee_proxy_media(iid:str, n:int, response:requests.Response) -> Iterator[bytes]:
+    base, metapath = get_proxy_paths(iid, n)
+    kind, ext = get_http_mime(response)
+    path = f"{base}.{ext}"
+    temp_path = f"{path}.{os.getpid()}-{get_ident()}.tmp"
+    mkfiledir(path)
+    complete = False
+    try:
+        with response, open(temp_path, "wb") as f:
+            for chunk in response.iter_content(PROXY_CHUNK):
+                f.write(chunk)
+                yield chunk
+        os.replace(temp_path, path)
+        write_textual(metapath, f"{kind}/{ext}", False)
+        complete = True
+        proxy_stats["Stored"] += 1
+    finally:
+        if not complete:
+            proxy_stats["Aborted"] += 1
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+def stream_remote(response:requests.Response) -> Iterator[bytes]:
+    with response:
+        yield from response.iter_content(PROXY_CHUNK)
 
-    resp = requests.get(url, timeout=10)
-    kind, ext = get_http_mime(resp)
-    mime = f"{kind}/{ext}"
+# remote media for building thumbnails: the path of the cached copy, downloaded without holding it in memory, or the bytes when not caching
+def fetch_proxy_media(iid:str, url:str, n:int=0) -> tuple[str|BytesIO, str]:
+    if (cached := read_proxy_cache(iid, n)):
+        return cached
 
-    if Config.PROXY_CACHE:
-        path = os.path.join(PROXY_ROOT, f"{iid}.{ext}")
-        mkfiledir(path)
-        with open(path, "wb") as f:
-            f.write(resp.content)
-        write_textual(metapath, mime, False)
+    response = requests.get(url, timeout=10, stream=True)
+    kind, ext = get_http_mime(response)
+    if Config.PROXY_CACHE and response.status_code == 200:
+        for chunk in tee_proxy_media(iid, n, response):
+            pass
+        if (cached := read_proxy_cache(iid, n)):
+            return cached
+    with response:
+        return BytesIO(response.content), f"{kind}/{ext}"
 
-    return resp.content, mime
+# remote media for clients: served with Range support from the cached copy if there is one, otherwise streamed, and stored along the way;
+#  a request for a later part of a file not cached yet is passed on upstream as is, without being stored
+def serve_proxy_media(iid:str, url:str, n:int=0):
+    if (cached := read_proxy_cache(iid, n)):
+        proxy_stats["Cache hits"] += 1
+        path, mime = cached
+        return send_file(path, mimetype=mime, conditional=True)
+
+    ranged = (byte_range := request.headers.get("Range")) and byte_range.replace(" ", "") != "bytes=0-"
+    response = requests.get(url, timeout=10, stream=True, headers=({"Range": byte_range} if byte_range and ranged else {}))
+    kind, ext = get_http_mime(response)
+    headers = {key: response.headers[key] for key in ("Content-Range", "Accept-Ranges", "Last-Modified", "ETag") if key in response.headers}
+    if "Content-Length" in response.headers and "Content-Encoding" not in response.headers:
+        headers["Content-Length"] = response.headers["Content-Length"]
+    if Config.PROXY_CACHE and response.status_code == 200:
+        proxy_stats["Streamed"] += 1
+        body = tee_proxy_media(iid, n, response)
+    else:
+        proxy_stats["Ranges passed through" if response.status_code == 206 else "Streamed"] += 1
+        body = stream_remote(response)
+    return Response(body, status=response.status_code, mimetype=f"{kind}/{ext}", headers=headers)
 
 def build_video_thumb(video: str) -> bytes:
     if isinstance(video, BytesIO):
@@ -115,41 +178,285 @@ def build_video_thumb(video: str) -> bytes:
     )
     return ffmpeg.output(gif, "pipe:1", format="gif").run(capture_stdout=True)[0]
 
-def build_image_thumb(image_path: str) -> bytes:
-    pil = Image.open(image_path)
-    if pil.width > Config.THUMB_WIDTH:
-        pil = pil.resize(
-            (Config.THUMB_WIDTH, int(pil.height * Config.THUMB_WIDTH / pil.width)),
-            Image.LANCZOS, # type: ignore[attr-defined]
-        ) # type: ignore[assignment]
-    pil = pil.convert("RGBA") # type: ignore[assignment]
-    ImageFile.MAXBLOCK = pil.size[0] * pil.size[1]
-
-    buf = BytesIO()
-    pil.save(
-        buf,
-        format=Config.THUMB_TYPE,
-        quality=Config.THUMB_QUALITY,
-        optimize=True,
-        progressive=True,
-    )
-    return buf.getvalue()
+# EXIF orientations that swap the sides of the stored image
+TRANSPOSED_ORIENTATIONS = (5, 6, 7, 8)
+# images are first shrunk by a cheap integer factor (a JPEG draft or reduce()) to no less than this many times the target, and only the rest is resampled
+REDUCING_GAP = 3.0
+
+# every configured width is built from the same decode, largest first, each from the previous one; JPEGs are decoded straight at a reduced scale,
+#  orientation is fixed once on the already small image, and nothing process-wide is touched, since builds may run on several threads
+def build_image_thumbs(image_path: str) -> dict[int, bytes]:
+    thumbs = {}
+    with Image.open(image_path) as source:
+        width, height = source.size
+        if (transposed := source.getexif().get(ExifTags.Base.Orientation) in TRANSPOSED_ORIENTATIONS):
+            width, height = height, width
+        # the box must fit the target tightly, since the decoding scale is chosen from it
+        box = (Config.THUMB_WIDTHS[-1], max(1, round(height * Config.THUMB_WIDTHS[-1] / width)))
+        source.thumbnail((box[::-1] if transposed else box), Image.Resampling.LANCZOS, reducing_gap=REDUCING_GAP)
+        pil = ImageOps.exif_transpose(source).convert("RGBA" if source.has_transparency_data else "RGB")
+    for width in reversed(Config.THUMB_WIDTHS):
+        pil.thumbnail((width, pil.height), Image.Resampling.LANCZOS)
+        buf = BytesIO()
+        pil.save(
+            buf,
+            format=Config.THUMB_TYPE,
+            quality=Config.THUMB_QUALITY,
+            optimize=True,
+            progressive=True,
+        )
+        thumbs[width] = buf.getvalue()
+    return thumbs
+
+def get_thumb_width_path(path:str, width:int) -> str:
+    if width == Config.THUMB_WIDTH:
+        return path
+    base, ext = path.rsplit(".", 1)
+    return f"{base}.{width}.{ext}"
+
+def pick_thumb_width(requested:str|None) -> int:
+    if requested and requested.isdigit():
+        for width in Config.THUMB_WIDTHS:
+            if width >= int(requested):
+                return width
+    return Config.THUMB_WIDTH
+
+# the cache files of a thumbnail, for all of its widths
+def build_thumb(path:str, kind:str, media:str|bytes) -> dict[str, bytes]:
+    source = (media if isinstance(media, str) else BytesIO(media))
+    if kind == "video":
+        return {path: build_video_thumb(source)} # type: ignore[arg-type]
+    return {get_thumb_width_path(path, width): data for width, data in build_image_thumbs(source).items()} # type: ignore[arg-type]
+
+# runs in the pool processes, so it only takes and returns plain data
+def run_thumb_job(path:str, kind:str, media:str|bytes) -> tuple[dict[str, bytes], float]:
+    start = time.time()
+    files = build_thumb(path, kind, media)
+    return files, time.time() - start
+
+# where the thumbnail of an item is cached, which kind of build it needs and from what media, or the path of a file to serve as is; resolving remote media may fetch it through the proxy
+def get_thumb_source(item:ItemDict, video_thumbs:bool) -> tuple[str, str, str|bytes, str]|str|None:
+    if video_thumbs and item.get("video") and (video := resolve_media(item, "video")):
+        return (os.path.join(THUMBS_ROOT, f"{item['id']}.gif"), "video", get_media_source(video), "image/gif")
+    if item.get("image") and (image := resolve_media(item, "image")):
+        # GIF: passthrough solo se locale
+        if isinstance(image, str) and image.lower().endswith(".gif"):
+            return image
+        return (os.path.join(THUMBS_ROOT, f"{item['id']}.{Config.THUMB_TYPE}"), "image", get_media_source(image), f"image/{Config.THUMB_TYPE}")
+    return None
+
+# a path (local, or of the proxy cache) or the bytes of media, as resolved by resolve_media()
+def get_media_source(media:str|tuple[str|BytesIO, str]) -> str|bytes:
+    if isinstance(media, str):
+        return media
+    return (media[0] if isinstance(media[0], str) else media[0].getvalue())
+
+# written aside and then renamed into place, so that a cache file can never be read while still incomplete
+def store_cache_file(path:str, data:bytes) -> None:
+    mkfiledir(path)
+    temp_path = f"{path}.{os.getpid()}-{get_ident()}.tmp"
+    with open(temp_path, "wb") as f:
+        f.write(data)
+    os.replace(temp_path, path)
+
+# concurrent requests for the same cache file share a single build, started by the first of them, and builds of each kind are capped,
+#  so that a burst of requests for a new item spawns neither duplicate nor unbounded ffmpeg and node processes
+class SingleFlight:
+    def __init__(self, limits:dict[str, int]):
+        self.calls: dict[str, Future] = {}
+        self.limits = {kind: BoundedSemaphore(max(1, limit)) for kind, limit in limits.items()}
+        self.lock = Lock()
+        self.builds = self.joined = self.waiting = 0
+
+    def run(self, kind:str, key:str, function:Callable[[], Any]) -> Any:
+        with self.lock:
+            if (future := self.calls.get(key)):
+                self.joined += 1
+                leader = False
+            else:
+                self.calls[key] = (future := Future())
+                self.builds += 1
+                leader = True
+        if not leader:
+            return future.result()
+        try:
+            with self.lock:
+                self.waiting += 1
+            with self.limits[kind]:
+                with self.lock:
+                    self.waiting -= 1
+                result = function()
+            future.set_result(result)
+            return result
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "Builds started": self.builds,
+            "Requests joined": self.joined,
+            "In progress": len(self.calls),
+            "Waiting for a slot": self.waiting,
+        }
+
+cache_builds = SingleFlight({"image": Config.MAX_IMAGE_BUILDS, "video": Config.MAX_VIDEO_BUILDS, "render": Config.MAX_RENDER_BUILDS})
+METRICS["Cache Builds"] = cache_builds.stats
+
+# the cached file if it is there (maybe just written by a build that was already running), otherwise the output of the builder, stored when `cachable`;
+#  the builder can also return, by path, other files made along with the requested one, and those get stored as well; `group` is the path that
+#  requests for any of those files share a build under, so that asking for two of them at once doesn't run the builder twice
+def build_cached(path:str, kind:str, builder:Callable[[], bytes|dict[str, bytes]], cachable:bool=True, group:str|None=None) -> bytes:
+    def build() -> dict[str, bytes]:
+        if cachable and os.path.exists(path):
+            with open(path, "rb") as f:
+                return {path: f.read()}
+        files = builder()
+        if not isinstance(files, dict):
+            files = {path: files}
+        if cachable:
+            for filepath, data in files.items():
+                store_cache_file(filepath, data)
+        return files
+    files = cache_builds.run(kind, (group or path), build)
+    # a build joined while it was running might have been for a sibling that was already cached, and then only that one is in the result
+    if path not in files:
+        files = cache_builds.run(kind, (group or path), build)
+    return files[path]
+
+# thumbnails of new items, and of those likely to be requested soon (like collection covers), are queued to be built in the background,
+#  and every build, also the ones that requests wait for, runs in a pool of processes instead of on the HTTP threads
+class ThumbnailJobs:
+    def __init__(self, workers:int):
+        self.workers = workers
+        self.pool: ProcessPoolExecutor|None = None
+        self.started = False
+        self.queue: Queue[ItemDict] = Queue()
+        self.queued: set[str] = set()
+        self.lock = Lock()
+        self.running = self.skipped = self.pool_losses = 0
+        self.builds: dict[str, tuple[int, float, float]] = {}
+        self.failures: dict[str, int] = {}
+
+    def start(self) -> None:
+        if self.started:
+            return
+        self.started = True
+        if self.workers > 0:
+            # forked rather than spawned, since spawning would run the whole application module again in every worker; the workers are forked
+            #  right away by a first job, so this must be called before any other thread is started, or a child could inherit a lock held by one
+            self.pool = ProcessPoolExecutor(self.workers, mp_context=get_context("fork"))
+            self.pool.submit(os.getpid).result()
+        for _ in range(max(1, self.workers)):
+            Thread(target=self.run, daemon=True).start()
+
+    def enqueue(self, items:Iterable[ItemDict]) -> None:
+        if not (Config.USE_THUMBNAILS and Config.THUMBNAIL_CACHE):
+            return
+        for item in items:
+            with self.lock:
+                if item["id"] in self.queued:
+                    continue
+                self.queued.add(item["id"])
+            self.queue.put(item)
+
+    def run(self) -> None:
+        while True:
+            item = self.queue.get()
+            try:
+                # image thumbnails cached before more widths were configured lack some of them, and get built again
+                base = os.path.join(THUMBS_ROOT, f"{item['id']}.{Config.THUMB_TYPE}")
+                missing = [width_path for width in Config.THUMB_WIDTHS if not os.path.exists(width_path := get_thumb_width_path(base, width))]
+                if missing and not os.path.exists(os.path.join(THUMBS_ROOT, f"{item['id']}.gif")) and type(source := get_thumb_source(item, FFMPEG_AVAILABLE)) == tuple:
+                    path, kind, media, mimetype = source
+                    build_cached((missing[0] if kind == "image" else path), kind, (lambda: self.build(path, kind, media)), group=path)
+                else:
+                    self.skipped += 1
+            except Exception:
+                app.logger.exception(f"Thumbnail job error on {item['id']}")
+            with self.lock:
+                self.queued.discard(item["id"])
+            self.queue.task_done()
+
+    def build(self, path:str, kind:str, media:str|bytes) -> dict[str, bytes]:
+        with self.lock:
+            self.running += 1
+        try:
+            files, seconds = self.dispatch(path, kind, media)
+        except Exception:
+            with self.lock:
+                self.failures[kind] = self.failures.get(kind, 0) + 1
+            raise
+        finally:
+            with self.lock:
+                self.running -= 1
+        with self.lock:
+            count, total, slowest = self.builds.get(kind, (0, 0.0, 0.0))
+            self.builds[kind] = (count + 1, total + seconds, max(slowest, seconds))
+        return files
+
+    # a worker that died (killed for memory, or crashed in a codec) leaves the pool unusable; it can't be forked again safely now that threads are
+    #  running, so builds go on in this process, except for the ones that were in flight, which might have been the cause and fail instead
+    def dispatch(self, path:str, kind:str, media:str|bytes) -> tuple[dict[str, bytes], float]:
+        if (pool := self.pool):
+            try:
+                future = pool.submit(run_thumb_job, path, kind, media)
+            except BrokenProcessPool:
+                self.drop_pool(pool)
+            else:
+                try:
+                    return future.result()
+                except BrokenProcessPool:
+                    self.drop_pool(pool)
+                    raise
+        return run_thumb_job(path, kind, media)
+
+    def drop_pool(self, pool:ProcessPoolExecutor) -> None:
+        with self.lock:
+            if self.pool is not pool:
+                return
+            self.pool = None
+            self.pool_losses += 1
+        pool.shutdown(wait=False)
+        app.logger.error("Thumbnail worker pool broke, building thumbnails in-process from now on")
+
+    def stats(self) -> dict[str, int|float]:
+        stats: dict[str, int|float] = {
+            "Workers": (self.workers if self.pool else 0),
+            "Queue depth": self.queue.qsize(),
+            "Building": self.running,
+            "Skipped (cached)": self.skipped,
+            "Pool losses": self.pool_losses,
+        }
+        for kind, (count, total, slowest) in sorted(self.builds.items()):
+            stats[f"Built ({kind})"] = count
+            stats[f"Average build (s, {kind})"] = round(total / count, 3)
+            stats[f"Slowest build (s, {kind})"] = round(slowest, 3)
+        for kind, count in sorted(self.failures.items()):
+            stats[f"Failures ({kind})"] = count
+        return stats
+
+thumb_jobs = ThumbnailJobs(Config.THUMBNAIL_WORKERS)
+METRICS["Thumbnail Jobs"] = thumb_jobs.stats
+
+def warm_thumbs(items:Iterable[ItemDict]) -> None:
+    thumb_jobs.enqueue(items)
 
 def serve_or_build(
     path: str,
     cachable: bool,
-    builder: Callable[[], bytes],
+    builder: Callable[[], bytes|dict[str, bytes]],
     mimetype: str | None = None,
+    kind: str = "image",
+    group: str | None = None,
 ):
     if cachable and os.path.exists(path):
         return send_file(path, mimetype=mimetype)
 
-    data = builder()
-
-    if cachable:
-        mkfiledir(path)
-        with open(path, "wb") as f:
-            f.write(data)
+    data = build_cached(path, kind, builder, cachable, group)
 
     return send_file(
         BytesIO(data),
@@ -176,3 +483,5 @@ def check_ffmpeg_available():
     except ffmpeg.Error:
         pass
     return True
+
+FFMPEG_AVAILABLE = check_ffmpeg_available()
@@ -1,10 +1,8 @@
 import os
-from typing import TypedDict, Required, Literal, Any
+from typing import TypedDict, Required, Literal, Callable, Any
 from secrets import token_urlsafe
 from datetime import datetime
 from snowflake import SnowflakeGenerator # type: ignore[import-untyped]
-from queue import Queue
-from threading import Thread
 from _util import *
 
 class DataContainer:
@@ -96,6 +94,8 @@ CACHE_ROOT = f"{DATA_ROOT}/cache"
 THUMBS_ROOT = f"{CACHE_ROOT}/thumbs"
 RENDERS_ROOT = f"{CACHE_ROOT}/renders"
 PROXY_ROOT = f"{CACHE_ROOT}/proxy"
+METADATA_ROOT = f"{CACHE_ROOT}/metadata"
+INDEX_DB = f"{CACHE_ROOT}/index.sqlite"
 EXTENSIONS = {
     "image": ("mpo", "jpg", "jpeg", "jfif", "bmp", "png", "apng", "gif", "webp", "avif", "svg"),
     "video": ("mp4", "mov", "mpg", "ogv", "webm", "mkv"),
@@ -113,6 +113,7 @@ LISTS_EXT = ".wsv"
 # EVENTS_EXT = f".events{LISTS_EXT}"
 MEDIA_TYPES = [kind for kind in EXTENSIONS.keys() if "." not in kind]
 MODERATION_LIST = f"{DATA_ROOT}/moderation{LISTS_EXT}"
+TOKENS_USAGE_LIST = f"{DATA_ROOT}/tokens-usage{LISTS_EXT}"
 ATOM_CONTENT_TYPE = "application/atom+xml; charset=UTF-8"
 ACTIVITYPUB_TYPES = ['application/ld+json; profile="https://www.w3.org/ns/activitystreams"', "application/activity+json"]
 
@@ -140,6 +141,9 @@ class Config:
     HTTP_HOST = _get("http_host")
     HTTP_PORT = int(_get("http_port"))
     HTTP_THREADS = int(_get("http_threads"))
+    PASSWORD_HASH_WORKERS = int(_get("password_hash_workers"))
+    PASSWORD_HASH_QUEUE = int(_get("password_hash_queue"))
+    PASSWORD_HASH_PER_CLIENT = int(_get("password_hash_per_client"))
     LINKS_PREFIX = _get("links_prefix")
     RESULTS_LIMIT = int(_get("results_limit"))
     AUTO_OCR = parse_bool_strict(_get("auto_ocr"))
@@ -158,14 +162,31 @@ class Config:
     THUMBNAIL_CACHE = parse_bool_strict(_get("thumbnail_cache"))
     RENDER_CACHE = parse_bool_strict(_get("render_cache"))
     PROXY_CACHE = parse_bool_strict(_get("proxy_cache"))
+    ITEM_CACHE_SIZE = int(_get("item_cache_size"))
+    ITEM_CACHE_MEGABYTES = int(_get("item_cache_megabytes"))
+    COLLECTION_CACHE_SIZE = int(_get("collection_cache_size"))
+    USER_CACHE_SIZE = int(_get("user_cache_size"))
+    METADATA_SIDECARS = parse_bool_strict(_get("metadata_sidecars"))
     VIDEO_THUMB_DURATION = int(_get("video_thumbnail_duration"))
     VIDEO_THUMB_WIDTH = int(_get("video_thumbnail_width"))
     VIDEO_THUMB_FPS = int(_get("video_thumbnail_fps"))
     THUMB_QUALITY = int(_get("image_thumbnail_quality"))
     THUMB_WIDTH = int(_get("image_thumbnail_width"))
+    THUMB_WIDTHS = sorted(set(map(int, filter(None, _get("image_thumbnail_widths").split(",")))) | {THUMB_WIDTH})
     THUMB_TYPE = _get("image_thumbnail_type")
+    THUMBNAIL_WORKERS = int(_get("thumbnail_workers"))
+    MAX_IMAGE_BUILDS = int(_get("max_image_builds"))
+    MAX_VIDEO_BUILDS = int(_get("max_video_builds"))
+    MAX_RENDER_BUILDS = int(_get("max_render_builds"))
     RENDER_TYPE = _get("image_render_type")
     USE_BAK_FILES = parse_bool_strict(_get("use_bak_files"))
+    WATCH_FILES = parse_bool_strict(_get("watch_files"))
+    WATCH_INTERVAL = float(_get("watch_interval"))
+    COUNTERS_INTERVAL = float(_get("counters_interval"))
+    EVENTS_FLUSH_INTERVAL = float(_get("events_flush_interval"))
+    EVENTS_FSYNC = _get("events_fsync")
+    EVENTS_SEGMENT_KILOBYTES = int(_get("events_segment_kilobytes"))
+    EVENTS_FANOUT_WORKERS = int(_get("events_fanout_workers"))
     # PANSTORAGE_URL = ""
     SITE_VERIFICATION = {
         "GOOGLE": _get("site_verification_google"),
@@ -175,21 +196,8 @@ class Config:
 snowflake_epoch = int(datetime(2025, 1, 1, 0, 0, 0).timestamp() * 1000)
 snowflake = SnowflakeGenerator(1, epoch=snowflake_epoch)
 
-# events_queue = Queue()
-moderation_queue: Queue[str] = Queue()
-
-# def events_writer():
-
-def moderation_writer():
-    with open(MODERATION_LIST, "a") as f:
-        while True:
-            f.write(moderation_queue.get() + "\n")
-            f.flush()
-            #os.fsync(f)
-            moderation_queue.task_done()
-
-# Thread(target=events_writer).start()
-Thread(target=moderation_writer, daemon=True).start()
+# live counters of background subsystems, shown in the administration page
+METRICS: dict[str, Callable[[], dict[str, Any]]] = {}
 
 STRINGS = {
     "Profile": {
@@ -228,6 +236,15 @@ STRINGS = {
     "Cache cleared": {
         "it": "Cache pulita",
     },
+    "Rebuild Index": {
+        "it": "Ricostruisci Indice",
+    },
+    "Index rebuilt": {
+        "it": "Indice ricostruito",
+    },
+    "Caches": {
+        "it": "Cache",
+    },
     "Clear BAK Files": {
         "it": "Pulisci File BAK",
     },
@@ -243,6 +260,42 @@ STRINGS = {
     "Profile updated": {
         "it": "Profilo aggiornato",
     },
+    "Saved by": {
+        "it": "Salvato da",
+    },
+    "API Tokens": {
+        "it": "Token API",
+    },
+    "Last used": {
+        "it": "Ultimo uso",
+    },
+    "Requests": {
+        "it": "Richieste",
+    },
+    "Password Hashing": {
+        "it": "Hash delle Password",
+    },
+    "Storage": {
+        "it": "Spazio Occupato",
+    },
+    "Media": {
+        "it": "Media",
+    },
+    "Types": {
+        "it": "Tipi",
+    },
+    "Counters": {
+        "it": "Contatori",
+    },
+    "Video": {
+        "it": "Video",
+    },
+    "Audio": {
+        "it": "Audio",
+    },
+    "Carousel": {
+        "it": "Carosello",
+    },
     "Statistics": {
         "it": "Statistiche",
     },
@@ -279,6 +332,9 @@ STRINGS = {
     "Collection": {
         "it": "Raccolta",
     },
+    "Collections": {
+        "it": "Raccolte",
+    },
     "New Collection": {
         "it": "Nuova Raccolta",
     },
@@ -476,9 +532,6 @@ STRINGS = {
         "en": "This media is marked as potentially sensitive, or \"not safe for work\". Click it to reveal it.",
         "it": "Questo media è indicato come potenzialmente sensibile, o \"not safe for work\". Cliccalo per rivelarlo.",
     },
-    "API Tokens": {
-        "it": "Token API",
-    },
     "Create New Token": {
         "it": "Crea Nuovo Token",
     },
@@ -494,6 +547,10 @@ STRINGS = {
         "en": "Invalid username or password",
         "it": "Username o password errati",
     },
+    "too-many-logins": {
+        "en": "Too many login attempts right now, please retry in a few seconds",
+        "it": "Troppi tentativi di accesso in questo momento, riprova tra qualche secondo",
+    },
     "Not Found": {
         "it": "Non Trovato",
     },
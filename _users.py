@@ -1,32 +1,44 @@
 import os
 from flask_login import UserMixin # type: ignore[import-untyped]
 from typing import cast
-from _util import generate_user_hash, read_metadata, read_textual, write_textual, write_metadata, slugify_name
-from _pignio import UserDict, DataContainer, USERS_ROOT, ITEMS_EXT
+from _util import generate_user_hash, read_metadata_file, slugify_name
+from _pignio import UserDict, DataContainer, USERS_ROOT, ITEMS_EXT, Config
+from _collection_log import collection_items
+from _cache import LRUCache, estimate_size, stamp_paths
 from werkzeug.utils import safe_join
 
+# user files are read again at most every few seconds, unless saved through here
+USER_RECHECK_SECONDS = 2
+
+user_cache = LRUCache("Users", Config.USER_CACHE_SIZE, recheck_seconds=USER_RECHECK_SECONDS)
+
 class User(UserMixin, DataContainer):
     data: UserDict
     is_admin = False
     is_authed = False
 
-    def __init__(self, username:str, filepath:str|None=None, url:str|None=None):
+    def __init__(self, username:str, filepath:str|None=None, url:str|None=None, data:UserDict|None=None, session:tuple[str, str]|None=None):
         self.username = username
+        self.session = session
         self.filepath = filepath
         self.url = self.json_url = url
         if filepath:
             try:
-                self.data = cast(UserDict, read_metadata(read_textual(filepath)))
+                self.data = (data if data != None else cast(UserDict, read_metadata_file(filepath)))
                 self.is_admin = ("admin" in cast(list[str], self.data.get("roles", [])))
             except FileNotFoundError:
                 pass
 
+    # the session id is only computed again when the password changed
     def get_id(self) -> str:
-        return generate_user_hash(self.username, self.data["password"])
+        if not (self.session and self.session[0] == (password := self.data["password"])):
+            self.session = (password, generate_user_hash(self.username, password))
+        return self.session[1]
     
     def save(self) -> None:
         if self.filepath:
-            write_textual(self.filepath, write_metadata(self.data))
+            collection_items(self.filepath).save(self.data)
+            user_cache.invalidate(self.filepath)
         else:
             raise Exception
 
@@ -40,7 +52,17 @@ class RemoteUser(User):
 def load_user(username:str) -> User|None:
     username = slugify_name(username)
     filepath = safe_join(USERS_ROOT, (username + ITEMS_EXT))
-    if filepath and os.path.exists(filepath):
-        return User(username, filepath)
-    else:
+    if not filepath:
         return None
+    if (entry := user_cache.get(filepath)) == None:
+        stamp = stamp_paths((filepath,))
+        try:
+            data = cast(UserDict, read_metadata_file(filepath))
+        except FileNotFoundError:
+            return None
+        # cached along with the session id for the current password, so that checking the session of a request doesn't hash it every time
+        entry = (data, ((password, generate_user_hash(username, password)) if (password := data.get("password")) else None))
+        user_cache.put(filepath, entry, [filepath], estimate_size(data), stamp)
+    data, session = entry
+    # every user gets its own copy of the data, which views are free to change before saving
+    return User(username, filepath, data=cast(UserDict, {key: (list(value) if type(value) == list else value) for key, value in data.items()}), session=session)
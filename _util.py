@@ -1,5 +1,6 @@
 import os
 # import time
+import marshal
 import urllib.parse
 from pathlib import Path
 from slugify import slugify
@@ -7,8 +8,8 @@ from configparser import ConfigParser
 from shutil import copyfile
 from io import StringIO
 from base64 import urlsafe_b64encode
-from hashlib import sha256
-from typing import TypedDict
+from hashlib import sha256, blake2b
+from typing import TypedDict, Any, cast
 
 class MetaDict(TypedDict):
     ...
@@ -54,7 +55,30 @@ def host_to_absolute(host:str) -> str:
         host = f"https://{host}"
     return host
 
-def read_ini(text:str):
+# same result as parsing the text as the [DEFAULT] section of a ConfigParser, for the plain key = value files Pignio writes;
+# anything unusual (section headers, duplicate keys, lines without a delimiter) is left to ConfigParser itself, with its same errors
+def read_ini(text:str) -> dict[str, str]:
+    data: dict[str, list[str]] = {}
+    key = None
+    indent_level = 0
+    for line in text.split("\n"):
+        value = line.strip()
+        if not value or value[0] in "#;":
+            if key and not value:
+                data[key].append("") # newlines are added when joining
+            continue
+        indent = len(line) - len(line.lstrip())
+        if key and indent > indent_level:
+            data[key].append(value)
+            continue
+        indent_level = indent
+        delimiter = min((index for index in (value.find("="), value.find(":")) if index >= 0), default=-1)
+        if (value[0] == "[" and "]" in value[2:]) or delimiter <= 0 or not (key := value[:delimiter].rstrip().lower()) or key in data:
+            return read_ini_strict(text)
+        data[key] = [value[delimiter + 1:].strip()]
+    return {key: "\n".join(lines).rstrip() for key, lines in data.items()}
+
+def read_ini_strict(text:str) -> dict[str, str]:
     config = ConfigParser(interpolation=None)
     config.read_string(f"[DEFAULT]\n{text}")
     return config._defaults # type: ignore[attr-defined]
@@ -76,11 +100,47 @@ def wsv_to_list(data:str) -> list[str]:
 def safe_str_get(dikt:dict[str,str]|MetaDict|dict[str,str|None], key:str) -> str:
     return dikt and dikt.get(key) or ""
 
+# maps 0..count-1 onto a shuffled 0..count-1 in constant time: a small Feistel network over the next power of four, walking the cycle until it lands in range
+def permute_index(index:int, count:int, seed:int) -> int:
+    half = max(1, ((count - 1).bit_length() + 1) // 2)
+    mask = (1 << half) - 1
+    while True:
+        left, right = index >> half, index & mask
+        for round in range(4):
+            digest = blake2b(f"{seed}:{round}:{right}".encode(), digest_size=8).digest()
+            left, right = right, left ^ (int.from_bytes(digest, "big") & mask)
+        index = (left << half) | right
+        if index < count:
+            return index
+
 def generate_user_hash(username:str, password:str) -> str:
     return f"{username}:" + urlsafe_b64encode(sha256(password.encode()).digest()).decode()
 
 from _pignio import *
 
+# parsed metadata can be kept in a marshal sidecar under the cache folder, which is read instead of the text file as long as that one is unchanged
+def read_metadata_file(filepath:str) -> MetaDict:
+    if not Config.METADATA_SIDECARS or (relpath := os.path.relpath(filepath, DATA_ROOT)).startswith(".."):
+        return read_metadata(read_textual(filepath))
+    stat = os.stat(filepath)
+    stamp = (stat.st_mtime_ns, stat.st_size)
+    sidecar = os.path.join(METADATA_ROOT, f"{relpath}.bin")
+    try:
+        with open(sidecar, "rb") as f:
+            if (cached := marshal.loads(f.read()))[0] == stamp:
+                return cached[1]
+    except (OSError, EOFError, ValueError, TypeError, IndexError):
+        pass
+    data = read_metadata(read_textual(filepath))
+    try:
+        mkfiledir(sidecar)
+        with open(temp := f"{sidecar}.{os.getpid()}.tmp", "wb") as f:
+            f.write(marshal.dumps((stamp, cast(dict, data))))
+        os.replace(temp, sidecar)
+    except OSError:
+        pass
+    return data
+
 def write_textual(filepath:str, content:str, allow_bak:bool=True) -> None:
     if allow_bak and Config.USE_BAK_FILES and os.path.isfile(filepath):
         copyfile(filepath, f"{filepath}.bak")
@@ -88,11 +148,11 @@ def write_textual(filepath:str, content:str, allow_bak:bool=True) -> None:
         f.write(content)
 
 def read_metadata(text:str) -> MetaDict:
-    data = read_ini(text)
+    data: dict[str, Any] = read_ini(text)
     for key in ("items", "systags", "langs", "roles", "tokens", "images"):
         if key in data:
             data[key] = wsv_to_list(data[key])
-    return data
+    return cast(MetaDict, data)
 
 def write_metadata(data:dict[str, str]|MetaDict) -> str:
     output = StringIO()
@@ -0,0 +1,177 @@
+import os
+import time
+import struct
+import ctypes
+import ctypes.util
+from threading import Thread, Condition
+from typing import Callable, Any
+from _pignio import Config, METRICS
+from _app_factory import app
+
+IN_MODIFY = 0x2
+IN_ATTRIB = 0x4
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+WATCH_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+EVENT_HEADER = struct.Struct("iIII")
+
+# changes are dispatched only after a path stays quiet for this long, so that bursts of writes to the same file are handled once
+SETTLE_SECONDS = 0.5
+
+class FileWatcher:
+    def __init__(self):
+        self.handlers: dict[str, tuple[Callable[[str, bool], None], Callable[[], Any]|None]] = {}
+        self.pending: dict[str, tuple[float, float, bool]] = {}
+        self.condition = Condition()
+        self.mode: str|None = None
+        self.overflowed = False
+        self.processed = self.overflows = self.errors = 0
+        self.lag_last = self.lag_max = 0.0
+
+    # `on_change` receives paths relative to `root`, `on_overflow` is called when events were lost and a full rescan is needed
+    def register(self, root:str, on_change:Callable[[str, bool], None], on_overflow:Callable[[], Any]|None=None) -> None:
+        self.handlers[os.path.normpath(root)] = (on_change, on_overflow)
+
+    def start(self) -> None:
+        if self.mode or not self.handlers:
+            return
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+            fd = libc.inotify_init1(IN_CLOEXEC)
+            if fd < 0:
+                raise OSError(ctypes.get_errno(), "inotify_init1")
+            self.mode = "inotify"
+            Thread(target=self.run_inotify, args=(libc, fd), daemon=True).start()
+        except (OSError, AttributeError, TypeError):
+            self.mode = "polling"
+            Thread(target=self.run_polling, daemon=True).start()
+        Thread(target=self.run_dispatcher, daemon=True).start()
+
+    def notify(self, path:str, is_dir:bool=False) -> None:
+        with self.condition:
+            now = time.time()
+            first = self.pending[path][0] if path in self.pending else now
+            self.pending[path] = (first, now, is_dir)
+            self.condition.notify()
+
+    # the rescan is left to the dispatcher, so that events keep being read meanwhile
+    def overflow(self) -> None:
+        self.overflows += 1
+        with self.condition:
+            self.pending.clear()
+            self.overflowed = True
+            self.condition.notify()
+
+    def rescan(self) -> None:
+        for root, (on_change, on_overflow) in self.handlers.items():
+            if on_overflow:
+                try:
+                    on_overflow()
+                except Exception:
+                    self.errors += 1
+                    app.logger.exception(f"File watcher error on rescan of {root}")
+
+    def run_dispatcher(self) -> None:
+        while True:
+            with self.condition:
+                while not (self.pending or self.overflowed):
+                    self.condition.wait()
+                overflowed, self.overflowed = self.overflowed, False
+                now = time.time()
+                ready = [(path, entry) for path, entry in self.pending.items() if now - entry[1] >= SETTLE_SECONDS]
+                for path, entry in ready:
+                    del self.pending[path]
+                if not (ready or overflowed):
+                    self.condition.wait(SETTLE_SECONDS)
+                    continue
+            if overflowed:
+                self.rescan()
+            for path, (first, last, is_dir) in ready:
+                self.dispatch(path, is_dir)
+                self.lag_last = time.time() - first
+                self.lag_max = max(self.lag_max, self.lag_last)
+                self.processed += 1
+
+    def dispatch(self, path:str, is_dir:bool) -> None:
+        for root, (on_change, on_overflow) in self.handlers.items():
+            if path == root or path.startswith(root + os.sep):
+                try:
+                    on_change("" if path == root else os.path.relpath(path, root).replace(os.sep, "/"), is_dir)
+                except Exception:
+                    self.errors += 1
+                    app.logger.exception(f"File watcher error on {path}")
+
+    def run_inotify(self, libc:ctypes.CDLL, fd:int) -> None:
+        watches: dict[int, str] = {}
+
+        def watch_tree(path:str, announce:bool=False) -> None:
+            for root, dirs, files in os.walk(path):
+                if (wd := libc.inotify_add_watch(fd, root.encode(), WATCH_MASK)) >= 0:
+                    watches[wd] = root
+                if announce: # files created before the watch was in place, as when copying in a whole folder
+                    for file in files:
+                        self.notify(os.path.join(root, file))
+
+        for root in self.handlers:
+            watch_tree(root)
+
+        while True:
+            data = os.read(fd, 64 * 1024)
+            offset = 0
+            while offset < len(data):
+                wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)
+                name = data[offset + EVENT_HEADER.size:offset + EVENT_HEADER.size + length].rstrip(b"\0").decode(errors="surrogateescape")
+                offset += EVENT_HEADER.size + length
+                if mask & IN_Q_OVERFLOW:
+                    self.overflow()
+                elif mask & IN_IGNORED:
+                    watches.pop(wd, None)
+                elif (base := watches.get(wd)):
+                    path = os.path.join(base, name) if name else base
+                    is_dir = bool(mask & IN_ISDIR)
+                    if is_dir and mask & (IN_CREATE | IN_MOVED_TO):
+                        watch_tree(path, True)
+                    self.notify(path, is_dir)
+
+    def run_polling(self) -> None:
+        snapshot = self.scan()
+        while True:
+            time.sleep(Config.WATCH_INTERVAL)
+            current = self.scan()
+            for path in current.keys() | snapshot.keys():
+                if current.get(path) != snapshot.get(path):
+                    self.notify(path)
+            snapshot = current
+
+    def scan(self) -> dict[str, tuple[int, int]]:
+        files = {}
+        for base in self.handlers:
+            for root, dirs, names in os.walk(base):
+                for name in names:
+                    try:
+                        stat = os.stat(path := os.path.join(root, name))
+                        files[path] = (stat.st_mtime_ns, stat.st_size)
+                    except OSError:
+                        pass
+        return files
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            "Mode": self.mode or "off",
+            "Queue depth": len(self.pending),
+            "Events processed": self.processed,
+            "Last lag (s)": round(self.lag_last, 3),
+            "Max lag (s)": round(self.lag_max, 3),
+            "Overflows": self.overflows,
+            "Errors": self.errors,
+        }
+
+file_watcher = FileWatcher()
+METRICS["File Watcher"] = file_watcher.stats
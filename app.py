@@ -1,4 +1,5 @@
 import os
+import sys
 import time
 import urllib.parse
 import subprocess
@@ -8,8 +9,8 @@ import requests
 from io import BytesIO
 from hashlib import sha256
 from shutil import rmtree, move, copyfile
-from typing import Any, cast
-from random import shuffle
+from typing import Any, Iterable, cast
+from itertools import islice, chain
 from base64 import urlsafe_b64decode
 from datetime import datetime
 from glob import glob
@@ -22,6 +23,7 @@ from wtforms import StringField, PasswordField, BooleanField, SubmitField # type
 from wtforms.validators import DataRequired # type: ignore[import-untyped]
 from werkzeug.utils import safe_join
 from secrets import token_urlsafe
+from threading import Thread
 from _app_factory import app
 from _util import *
 from _pignio import *
@@ -30,8 +32,8 @@ from _features import *
 from _media import *
 from _users import *
 from _auth import *
-
-FFMPEG_AVAILABLE = check_ffmpeg_available()
+from _cache import CACHES
+from _events import event_writer, event_fanout
 
 app.jinja_env.globals["_"] = gettext
 app.jinja_env.globals["getlang"] = getlang
@@ -39,6 +41,7 @@ app.jinja_env.globals["gettheme"] = gettheme
 app.jinja_env.globals["json"] = json
 app.jinja_env.globals["clean_url_for"] = clean_url_for
 app.jinja_env.globals["extra_params"] = extra_params
+app.jinja_env.globals["unread_events"] = (lambda user: event_store.unread(user.username, user.is_admin))
 app.jinja_env.globals["ATOM_CONTENT_TYPE"] = ATOM_CONTENT_TYPE
 app.config["DEVELOPMENT"] = Config.DEVELOPMENT
 app.config["SECRET_KEY"] = Config.SECRET_KEY
@@ -59,6 +62,20 @@ app.config["CONFIG"] = Config
 app.config["FFMPEG_AVAILABLE"] = FFMPEG_AVAILABLE
 app.config["VIDEO_THUMBS"] = FFMPEG_AVAILABLE and Config.USE_THUMBNAILS
 
+ensure_index()
+token_registry.load()
+
+# the background workers are only started when serving, since scripts like manage.py and freeze.py import this module too
+def start_services() -> None:
+    # first, since its worker processes are forked before any thread is running
+    thumb_jobs.start()
+    if Config.WATCH_FILES:
+        file_watcher.start()
+    Thread(target=token_registry.run, daemon=True).start()
+    Thread(target=run_counters_reconciler, daemon=True).start()
+    event_writer.start()
+    event_fanout.start()
+
 login_manager = LoginManager()
 login_manager.login_view = "view_login"
 login_manager.init_app(app)
@@ -107,9 +124,10 @@ def serve_nodeinfo_21():
         "openRegistrations": app.config["ALLOW_REGISTRATION"],
         "usage": {
             "users": {
-                "total": count_users(),
+                "total": (counters := item_index.counters()).get("users", 0),
             },
-            "localPosts": count_items(),
+            "localPosts": counters.get("items", 0),
+            "localComments": counters.get("comments", 0),
         },
         "metadata": {
             "nodeName": app.config["INSTANCE_NAME"],
@@ -185,11 +203,9 @@ def proxy_media(iid:str, n:int):
     n = int(n)
     if (item := load_item(iid)):
         if not n and ((media := item.get("video")) or (media := item.get("audio")) or (media := item.get("image"))) and (url := parse_absolute_url(media)):
-            data, mime = fetch_proxy_media(iid, url)
-            return response_with_type(data, mime)
+            return serve_proxy_media(iid, url)
         elif n and (images := item.get("images")) and (url := parse_absolute_url(images[n - 1])):
-            data, mime = fetch_proxy_media(iid, url, n)
-            return response_with_type(data, mime)
+            return serve_proxy_media(iid, url, n)
     return abort(404)
 
 @app.route("/thumb/<path:iid>")
@@ -201,45 +217,12 @@ def serve_thumb(iid: str):
     if not item:
         abort(404)
 
-    if FFMPEG_AVAILABLE and item.get("video"):
-        src = resolve_media(item, "video")
-        if src:
-            path = os.path.join(THUMBS_ROOT, f"{iid}.gif")
-
-            def build():
-                if isinstance(src, str):
-                    return build_video_thumb(src)
-                bio, _ = src
-                return build_video_thumb(bio)
-
-            return serve_or_build(
-                path,
-                Config.THUMBNAIL_CACHE,
-                build,
-                "image/gif",
-            )
-
-    if item.get("image"):
-        src = resolve_media(item, "image")
-        if src:
-            # GIF: passthrough solo se locale
-            if isinstance(src, str) and src.lower().endswith(".gif"):
-                return send_file(src)
-
-            path = os.path.join(THUMBS_ROOT, f"{iid}.{Config.THUMB_TYPE}")
-
-            def build():
-                if isinstance(src, str):
-                    return build_image_thumb(src)
-                bio, _ = src
-                return build_image_thumb(bio)
-
-            return serve_or_build(
-                path,
-                Config.THUMBNAIL_CACHE,
-                build,
-                f"image/{Config.THUMB_TYPE}",
-            )
+    if isinstance(source := get_thumb_source(item, FFMPEG_AVAILABLE), str):
+        return send_file(source)
+    elif source:
+        path, kind, media, mimetype = source
+        target = (get_thumb_width_path(path, pick_thumb_width(request.args.get("w"))) if kind == "image" else path)
+        return serve_or_build(target, Config.THUMBNAIL_CACHE, (lambda: thumb_jobs.build(path, kind, media)), mimetype, kind, path)
 
     abort(404)
 
@@ -254,11 +237,7 @@ def render_media(iid:str):
             args = ["node", "render.js"]
             if (background := item.get("image")):
                 args.append(os.path.join(ITEMS_ROOT, background))
-            image, err = subprocess.Popen(args, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE).communicate(input=text.encode("utf-8"))
-            if Config.RENDER_CACHE:
-                mkfiledir(filepath)
-                with open(filepath, "wb") as f:
-                    f.write(image)
+            image = build_cached(filepath, "render", (lambda: subprocess.Popen(args, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE).communicate(input=text.encode("utf-8"))[0]), Config.RENDER_CACHE)
             return response_with_type(image, f"image/{Config.RENDER_TYPE}")
     return abort(404)
 
@@ -288,9 +267,9 @@ def view_item(iid:str, embed:bool=False):
                 if is_for_activitypub():
                     return make_activitypub_item(item)
                 else:
-                    comments = list(filter(lambda item: item.get("type") == "comment", walk_items(iid_to_filename(iid))))
+                    comments = walk_comments(iid)
                     comments.reverse()
-                    return render_template("item.html", embed=embed, item=item, comments=comments, get_item_permissions=get_item_permissions, time=time.time())
+                    return render_template("item.html", embed=embed, item=item, comments=comments, savers=item_index.count_savers(item["id"]), get_item_permissions=get_item_permissions, time=time.time())
             else:
                 [*item_toks, cid] = iid.split("/")
                 return redirect(url_for("view_item", iid="/".join(item_toks)) + f"#{cid}")
@@ -322,30 +301,22 @@ def view_user(username:str, cid:str|None=None):
             mode = request.args.get("mode")
             if mode == "all":
                 pinned = [item for folder in walk_collections(user.username).values() for item in folder["items"]]
-                created = [item for item in sort_items(walk_items(creator=user.username)) if item["id"] not in pinned]
-                return pagination("user.html", "items", created+pinned, user=user, load_item=load_item, mode=mode)
+                pinned_set = set(pinned)
+                created = (item for item in iter_items(creator=user.username, order="datetime") if item["id"] not in pinned_set)
+                return pagination("user.html", "items", chain(created, pinned), user=user, load_item=load_item, mode=mode)
             elif mode == "created":
-                return pagination("user.html", "items", sort_items(walk_items(creator=user.username)), user=user, load_item=load_item, mode=mode)
+                return pagination("user.html", "items", ItemsCursor(creator=user.username, order="datetime"), user=user, load_item=load_item, mode=mode)
             elif mode == "comments":
                 if current_user.is_authenticated and current_user.username == user.username:
-                    comments = sort_items(walk_items(creator=user.username, comments=True))
-                    for comment in comments:
-                        tokens = comment['id'].split('/')
-                        comment['iid'] = '/'.join(tokens[:-1])
-                        comment['cid'] = tokens[-1]
-                    return pagination("user.html", "comments", comments, user=user, load_item=load_item, mode=mode)
+                    return pagination("user.html", "comments", ItemsCursor(creator=user.username, comments=True, order="datetime", kind="comment"), user=user, load_item=load_item, mode=mode)
                 else:
                     return abort(404)
             else:
                 collections = walk_collections(user.username)
-                pinned = collections.pop("")
-                folders = make_folders(collections)
-                if cid:
-                    if (pinned := collections.get(cid)):
-                        folders = []
-                    else:
-                        return abort(404)
-                return pagination("user.html", "items", pinned["items"], user=user, collection_meta=pinned, name=cid, folders=folders, load_item=load_item, mode=mode)
+                folders = ([] if cid else make_folders({name: collection for name, collection in collections.items() if name}))
+                if not (collection := collections.get(cid or "")):
+                    return abort(404)
+                return pagination("user.html", "items", collection["items"], user=user, collection_meta=collection, name=cid, folders=folders, load_item=load_item, mode=mode)
     return abort(404)
 
 @app.route("/user/<path:username>/feed", defaults={"cid": None}) # TODO deprecate this which could conflict with collections
@@ -381,30 +352,15 @@ def view_embed(kind:str, path:str):
 @noindex
 @auth_required_config(Config.RESTRICT_SEARCH)
 def search():
-    query_raw = query = request.args.get("query", "")
+    query = request.args.get("query", "")
     cased = parse_bool(request.args.get("cased"))
     field = request.args.get("field", "")
     langs = " ".join(request.args.getlist("langs")).lower().replace("+", " ").replace(",", " ").split()
     creators = request.args.get("creators", "").lower().replace("+", " ").replace(",", " ").split()
-    if not cased:
-        query = query.lower()
-    results = []
-    for item in walk_items():
-        if field:
-            value = item.get(field, "")
-            if query in (value if type(value) == str else list_to_wsv(value)).lower().replace("\n", " "):
-                results.append(item)
-        elif any([query in (value if type(value) == str else list_to_wsv(value)).lower().replace("\n", " ") for value in item.values()]):
-            results.append(item)
-    if len(langs) > 0:
-        results = list(filter(lambda item: len(set(item.get("langs", [])) & set(langs)) > 0, results))
-    if len(creators) > 0:
-        results = list(filter(lambda item: item.get("creator") in creators, results))
-    if (provenance := request.args.get("provenance")):
-        results = list(filter(lambda item: provenance in item.get("systags", []) if provenance else provenance not in item.get("systags", []), results))
-    if (nsfw := parse_bool(request.args.get("nsfw"))) != None:
-        results = list(filter(lambda item: "nsfw" in item.get("systags", []) if nsfw else "nsfw" not in item.get("systags", []), results))
-    return pagination("search.html", "items", results, query=query_raw, cased=cased, field=field, langs=langs, creators=", ".join(creators), provenance=provenance, nsfw=nsfw)
+    provenance = request.args.get("provenance")
+    nsfw = parse_bool(request.args.get("nsfw"))
+    results = item_index.search(query, field, bool(cased), langs, creators, provenance, nsfw)
+    return pagination("search.html", "items", results, query=query, cased=cased, field=field, langs=langs, creators=", ".join(creators), provenance=provenance, nsfw=nsfw)
 
 @app.route("/trim", methods=["GET", "POST"])
 @query_params("iid")
@@ -427,6 +383,9 @@ def media_trim(iid:str):
                 if Config.USE_BAK_FILES:
                     copyfile(media_path, f"{media_path}.bak")
                 move(temp_path, media_path)
+                delete_item_cache(item["id"])
+                index_item(item["id"])
+                warm_thumbs([item])
                 return redirect(url_for("view_item", iid=item["id"]))
             elif action == "copy":
                 new_iid = generate_iid()
@@ -435,6 +394,8 @@ def media_trim(iid:str):
                 move(temp_path, f"{new_path}.{media_ext}")
                 if os.path.exists(old_ini):
                     copyfile(old_ini, new_path + ITEMS_EXT)
+                index_item(new_iid)
+                warm_thumbs(list(filter(None, [load_item(new_iid)])))
                 toggle_in_collection(current_user.username, "", new_iid, True)
                 return redirect(url_for("view_item", iid=new_iid))
     else:
@@ -466,6 +427,8 @@ def video_join():
                     ).output(item_path + ".mp4"
                     ).run(overwrite_output=True)
                 write_textual(item_path + ITEMS_EXT, write_metadata({"description": "Joined from " + " + ".join(iids)}))
+                index_item(iid)
+                warm_thumbs(list(filter(None, [load_item(iid)])))
                 toggle_in_collection(current_user.username, "", iid, True)
                 return redirect(url_for("view_item", iid=iid))
     return render_template("video-join.html", iids=iids)
@@ -517,13 +480,16 @@ def report_item():
         if request.method == "GET":
             return render_template("delete.html", item=item, mode="Report")
         elif request.method == "POST":
-            moderation_queue.put(f"report@{time.time()}:{iid},{current_user.username}")
+            event_writer.append(MODERATION_LIST, f"report@{time.time()}:{iid},{current_user.username}")
             return redirect(url_for("view_item", iid=iid))
     return abort(404)
 
-@app.route("/notifications")
+@app.route("/notifications", methods=["GET", "POST"])
 @extra_login_required
 def view_notifications():
+    if request.method == "POST":
+        event_store.mark_read(current_user.username, current_user.is_admin)
+        return "", 204
     return pagination("notifications.html", "events", load_events(current_user))
 
 @app.route("/settings", defaults={"cid": None}, methods=["GET", "POST"])
@@ -546,18 +512,21 @@ def view_settings(cid:str|None):
                 case "create-token":
                     token = token_urlsafe()
                     hashed = hash_api_token(token)
-                    tokens_raw.append(f"{time.time()}:{hashed}")
+                    tokens_raw.append(token_entry := f"{time.time()}:{hashed}")
+                    token_registry.add(user.username, token_entry)
                     tokens_changed = True
                     flash(f'{gettext("created-token")}: ({urlsafe_b64decode(hashed).hex()[:16]}) <input class="uk-input" style="width: 100%;" type="text" value="{user.username}:{token}" readonly />', "primary")
                 case "delete-token" if (hashed := request.form.get("token")) and (token := check_user_token(tokens_raw, hashed)):
                     tokens_raw.remove(token)
+                    token_registry.remove(hashed)
                     tokens_changed = True
                     flash(gettext("deleted-token"))
                 # case "create-webhook":
                 # case "delete-webhook":
         for token in tokens_raw:
             [timestamp, hashed] = token.split(":")
-            tokens.append({"date": datetime.fromtimestamp(float(timestamp)), "hash": hashed, "name": urlsafe_b64decode(hashed).hex()[:16]})
+            uses, last_used = token_registry.get_usage(hashed)
+            tokens.append({"date": datetime.fromtimestamp(float(timestamp)), "hash": hashed, "name": urlsafe_b64decode(hashed).hex()[:16], "uses": uses, "last_used": (datetime.fromtimestamp(last_used) if last_used else None)})
         if tokens_changed:
             user.data["tokens"] = tokens_raw
             user.save()
@@ -567,7 +536,8 @@ def view_settings(cid:str|None):
 @app.route("/stats")
 @noindex
 def view_stats():
-    return render_template("stats.html", items=count_items(), users=count_users())
+    counters = item_index.counters()
+    return render_template("stats.html", counters=counters, types=count_by_prefix(counters, "type:"), media=count_by_prefix(counters, "media:"))
 
 @app.route("/admin", methods=["GET", "POST"])
 @extra_login_required
@@ -578,7 +548,13 @@ def view_admin():
                 case "clear-cache":
                     if os.path.exists(CACHE_ROOT):
                         rmtree(CACHE_ROOT)
+                    for cache in CACHES:
+                        cache.clear()
+                    item_index.reset()
+                    rebuild_index()
                     flash(f'{gettext("Cache cleared")}!')
+                case "rebuild-index":
+                    flash(f'{gettext("Index rebuilt")}! ({rebuild_index()})')
                 case "clear-bak-files":
                     files = glob(f"{DATA_ROOT}/**/*.bak", recursive=True)
                     for file in files:
@@ -588,7 +564,7 @@ def view_admin():
                     if os.path.exists(TEMP_ROOT):
                         rmtree(TEMP_ROOT)
                     flash(f'{gettext("Temp files cleared")}!')
-        return render_template("admin.html")
+        return render_template("admin.html", caches=[cache.stats() for cache in CACHES], metrics={name: stats() for name, stats in METRICS.items()})
     else:
         abort(404)
 
@@ -601,13 +577,18 @@ def view_login():
     if form.validate_on_submit() and (user := load_user(form.username.data)):
         pass_equals = user.data["password"] == form.password.data
         try:
-            hash_equals = bcrypt.check_password_hash(user.data["password"], form.password.data)
+            hash_equals = password_hasher.run(user.username, bcrypt.check_password_hash, user.data["password"], form.password.data)
         except ValueError as e:
             hash_equals = False
+        except HasherBusy:
+            return too_many_logins(form, "Login")
         if pass_equals or hash_equals:
             if pass_equals:
-                user.data["password"] = bcrypt.generate_password_hash(user.data["password"]).decode("utf-8")
-                user.save()
+                try:
+                    user.data["password"] = password_hasher.run(user.username, bcrypt.generate_password_hash, user.data["password"]).decode("utf-8")
+                    user.save()
+                except HasherBusy:
+                    pass # the plain password will be hashed at the next login
             return init_user_session(user, form.remember.data)
     if request.method == "POST":
         flash(gettext("login-invalid"), "danger")
@@ -623,13 +604,21 @@ def view_register():
     form = RegisterForm()
     if form.validate_on_submit() and (username := form.username.data) and not (user := load_user(username)) and form.password.data == form.password2.data:
         user = User(username := slugify_name(username), safe_join(USERS_ROOT, (username + ITEMS_EXT)))
-        user.data["password"] = bcrypt.generate_password_hash(form.password.data).decode("utf-8")
+        try:
+            user.data["password"] = password_hasher.run(username, bcrypt.generate_password_hash, form.password.data).decode("utf-8")
+        except HasherBusy:
+            return too_many_logins(form, "Register")
         user.save()
+        item_index.bump("users")
         return init_user_session(user, form.remember.data)
     if request.method == "POST":
         flash(gettext("login-invalid"), "danger")
     return render_template("login.html", form=form, mode="Register")
 
+def too_many_logins(form:FlaskForm, mode:str):
+    flash(gettext("too-many-logins"), "danger")
+    return render_template("login.html", form=form, mode=mode), 429, {"Retry-After": "5"}
+
 @app.route("/logout")
 @noindex
 def logout():
@@ -656,9 +645,10 @@ def export_api():
     username = current_user.username
     userbase = os.path.join(USERS_ROOT, username)
     files = [[f"{userbase}.ini"], *[[filename] for filename in glob(f"{userbase}/*.ini")]]
-    for item in walk_items(creator=username):
-        filename = os.path.join(ITEMS_ROOT, iid_to_filename(item["id"]))
-        for filename in glob(f"{filename}.*"):
+    for [filename] in files:
+        collection_items(filename).flush()
+    for iid in walk_items(creator=username, only_ids=True):
+        for filename in find_files_for_iid(iid):
             files.append([filename])
     return send_zip_archive(username, files)
 
@@ -692,9 +682,10 @@ def collections_api(iid:str|None):
         if request.method == "POST":
             for collection, status in request.get_json().items():
                 toggle_in_collection(username, slugify_name(collection), iid, status)
+        pinned = item_index.pinned_in(username, iid)
         results: dict[str, bool] = {}
-        for cid, collection in walk_collections(username).items():
-            results[cid] = iid in collection["items"]
+        for cid in walk_collections(username):
+            results[cid] = cid in pinned
         return results
     else:
         collections = {}
@@ -707,7 +698,7 @@ def collections_api(iid:str|None):
 @app.route("/api/v0/comments/<path:iid>/<path:cid>", methods=["GET", "POST"])
 @auth_required
 def comments_api(iid:str, cid:str|None):
-    comments = list(filter(lambda item: item.get("type") == "comment", walk_items(iid_to_filename(iid))))
+    comments = walk_comments(iid)
     comment = None
     if cid:
         for item in comments:
@@ -771,7 +762,7 @@ def preview_api(url:str):
 def login_user_loader(userhash:str) -> User|None:
     username = userhash.split(":")[0]
     if (user := load_user(username)):
-        if userhash == generate_user_hash(username, user.data["password"]):
+        if userhash == user.get_id():
             return user
     return None
 
@@ -813,27 +804,48 @@ def view_orderable_items(root:str, embed:bool=False):
     elif ordering == "alphanumeric":
         modifier = (lambda items: sorted(items, key=(lambda item: item["id"])))
     return view_random_items(root, embed) if modifier == False else \
-            pagination("index.html", "items", walk_items(root), modifier, embed=embed, root=root, folders=list_folders(root), ordering=ordering)
+            pagination("index.html", "items", ItemsCursor(root), modifier, embed=embed, root=root, folders=list_folders(root), ordering=ordering)
 
 def view_random_items(root:str|None=None, embed:bool=False):
-    return pagination("index.html", "items", walk_items(root), (lambda items: shuffle(items)), embed=embed, root=root, folders=(list_folders(root) if root else []))
+    items = RandomItems(root, request.args.get("seed"))
+    return pagination("index.html", "items", items, embed=embed, root=root, folders=(list_folders(root) if root else []), seed=items.token())
 
-def pagination(template:str, key:str, all_items:list, modifier=None, **kwargs):
+def pagination(template:str, key:str, all_items:Iterable|ItemsCursor|RandomItems, modifier=None, **kwargs):
     page = int(request.args.get("page") or 1)
     limit = int(request.args.get("limit") or Config.RESULTS_LIMIT)
-    next_count = (limit * page)
-    items = all_items[(limit * (page - 1)):next_count]
-    if len(items) == 0 and len(all_items) > 0:
-        return abort(404)
+    after = decode_cursor(request.args.get("cursor"))
+    source: Iterable|RandomItems
+    if isinstance(all_items, ItemsCursor):
+        source = all_items(after)
+        skip = (0 if after else limit * (page - 1))
+    else:
+        source = all_items
+        skip = limit * (page - 1)
+    if isinstance(all_items, RandomItems):
+        # removed items leave gaps in a page, so whether there is more depends only on the position in the permutation
+        items = all_items[skip:(skip + limit)]
+        has_next = skip + limit < all_items.count
+        if skip >= all_items.count and page > 1:
+            return abort(404)
+    else:
+        items = list(source[skip:(skip + limit + 1)] if hasattr(source, "__getitem__") else islice(source, skip, skip + limit + 1))
+        has_next = len(items) > limit
+        items = items[:limit]
+        if len(items) == 0 and (page > 1 or after):
+            return abort(404)
+    next_cursor = encode_cursor(all_items.key(items[-1])) if has_next and isinstance(all_items, ItemsCursor) else None
     if modifier:
         modifier(items)
-    return render_template(template, **kwargs, **{key: items}, layout=request.args.get("layout"), limit=limit, next_page=(page + 1 if len(all_items) > next_count else None))
+    return render_template(template, **kwargs, **{key: items}, layout=request.args.get("layout"), limit=limit, next_page=(page + 1 if has_next else None), next_cursor=next_cursor)
 
 if __name__ == "__main__":
     print(f"Running Pignio on {Config.HTTP_HOST}:{Config.HTTP_PORT}...")
+    start_services()
 
     if Config.DEVELOPMENT:
         app.run(host=Config.HTTP_HOST, port=Config.HTTP_PORT, debug=True)
     else:
         import waitress
+        import signal
+        signal.signal(signal.SIGTERM, (lambda signum, frame: sys.exit(0))) # so that queued events are written out on exit
         waitress.serve(app, host=Config.HTTP_HOST, port=Config.HTTP_PORT, threads=Config.HTTP_THREADS)
@@ -0,0 +1,61 @@
+# Compares the ways of reading item metadata: the old ConfigParser path, the purpose-built parser, and the marshal sidecar cache.
+# Run from anywhere with `python benchmarks/metadata.py [files]`; it works on temporary copies and does not touch the data folder.
+import os
+import sys
+import tempfile
+from timeit import timeit
+
+os.chdir(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+sys.path.insert(0, os.getcwd())
+
+import _util
+from _util import read_ini_strict, read_metadata, read_metadata_file, read_textual, wsv_to_list, Config
+
+SAMPLE = """title = A sample item with a reasonably long title
+description = Some description text,
+	spanning a couple of lines
+	like the ones written by the editor.
+link = https://example.com/some/page?with=query&and=more
+image = 2025/10/237385087912513537.jpg
+creator = admin
+langs = en it
+systags = web nsfw
+alttext = Text recognized in the image, which can get quite long for screenshots of documents and such.
+"""
+
+def read_metadata_strict(text:str) -> dict:
+    data = read_ini_strict(text)
+    for key in ("items", "systags", "langs", "roles", "tokens", "images"):
+        if key in data:
+            data[key] = wsv_to_list(data[key])
+    return data
+
+def main() -> None:
+    texts = [read_textual(path) for path in sys.argv[1:]] or [SAMPLE]
+    rounds = max(1, 20000 // len(texts))
+    with tempfile.TemporaryDirectory() as root:
+        paths = []
+        for n, text in enumerate(texts):
+            with open(path := os.path.join(root, f"{n}.ini"), "w", encoding="utf-8") as f:
+                f.write(text)
+            paths.append(path)
+            if read_metadata(text) != read_metadata_strict(text):
+                print(f"Output differs for {sys.argv[1 + n] if len(sys.argv) > 1 else 'the sample'}!")
+        _util.DATA_ROOT = root
+        _util.METADATA_ROOT = os.path.join(root, "sidecars")
+
+        def run(name:str, function) -> None:
+            seconds = timeit(lambda: [function(value) for value in (paths if name.endswith("file") else texts)], number=rounds)
+            print(f"{name:<32} {seconds * 1e6 / (rounds * len(texts)):8.2f} µs per item")
+
+        run("ConfigParser text", read_metadata_strict)
+        run("fast parser text", read_metadata)
+        Config.METADATA_SIDECARS = False
+        run("ConfigParser file", lambda path: read_metadata_strict(read_textual(path)))
+        run("fast parser file", read_metadata_file)
+        Config.METADATA_SIDECARS = True
+        [read_metadata_file(path) for path in paths]
+        run("sidecar file", read_metadata_file)
+
+if __name__ == "__main__":
+    main()
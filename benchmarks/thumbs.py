@@ -0,0 +1,76 @@
+# Compares the old thumbnail path (full decode, LANCZOS resize of the original, RGBA conversion) with the current one (draft/reduce decode, EXIF
+#  transpose, RGB when there is no alpha), by time per source megapixel and by peak memory. Each build runs in its own forked process, so that the
+#  peak RSS of one does not hide the other (Linux only). Run with `python benchmarks/thumbs.py [images]`; without images it generates some in a temporary folder.
+import os
+import sys
+import time
+import shutil
+import tempfile
+from io import BytesIO
+from multiprocessing import get_context
+
+root = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, root)
+workdir = tempfile.mkdtemp()
+shutil.copy(os.path.join(root, "config.template.ini"), workdir)
+os.chdir(workdir)
+
+from PIL import Image, ImageFile
+from _media import build_image_thumbs, Config
+
+ROUNDS = 3
+SAMPLES = {"12MP.jpg": (4000, 3000), "40MP.jpg": (7300, 5475), "12MP.png": (4000, 3000)}
+
+def build_legacy(image_path:str) -> dict[int, bytes]:
+    pil = Image.open(image_path)
+    thumbs = {}
+    for width in reversed(Config.THUMB_WIDTHS):
+        if pil.width > width:
+            pil = pil.resize((width, int(pil.height * width / pil.width)), Image.LANCZOS) # type: ignore[attr-defined]
+        rgba = pil.convert("RGBA")
+        ImageFile.MAXBLOCK = rgba.size[0] * rgba.size[1]
+        buf = BytesIO()
+        rgba.save(buf, format=Config.THUMB_TYPE, quality=Config.THUMB_QUALITY, optimize=True, progressive=True)
+        thumbs[width] = buf.getvalue()
+    return thumbs
+
+def read_status(key:str) -> int:
+    with open("/proc/self/status") as f:
+        return next(int(line.split()[1]) for line in f if line.startswith(f"{key}:"))
+
+def measure(function, path:str, results) -> None:
+    # forked processes inherit the peak RSS of their parent, so it is reset before starting
+    with open("/proc/self/clear_refs", "w") as f:
+        f.write("5")
+    start_rss = read_status("VmRSS")
+    start = time.perf_counter()
+    for _ in range(ROUNDS):
+        thumbs = function(path)
+    results.put(((time.perf_counter() - start) / ROUNDS, read_status("VmHWM") - start_rss, sum(map(len, thumbs.values()))))
+
+def make_samples(folder:str) -> list[str]:
+    paths = []
+    for name, size in SAMPLES.items():
+        gradient = Image.linear_gradient("L").resize(size)
+        image = Image.merge("RGB", (gradient, gradient.transpose(Image.Transpose.ROTATE_90).resize(size), Image.effect_noise(size, 64)))
+        image.save(path := os.path.join(folder, name), quality=90)
+        paths.append(path)
+    return paths
+
+def main() -> None:
+    context = get_context("fork")
+    paths = sys.argv[1:] or make_samples(workdir)
+    print(f"{'image':<24} {'path':<8} {'ms/MP':>8} {'peak MB':>8} {'bytes':>8}")
+    for path in paths:
+        with Image.open(path) as image:
+            megapixels = image.width * image.height / 1e6
+        for name, function in (("old", build_legacy), ("new", build_image_thumbs)):
+            results = context.Queue()
+            (process := context.Process(target=measure, args=(function, path, results))).start()
+            seconds, peak, size = results.get()
+            process.join()
+            print(f"{os.path.basename(path):<24} {name:<8} {seconds * 1000 / megapixels:8.1f} {peak / 1024:8.1f} {size:8}")
+    shutil.rmtree(workdir)
+
+if __name__ == "__main__":
+    main()
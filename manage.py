@@ -0,0 +1,33 @@
+import sys
+from app import *
+
+COMMANDS = {
+    "reindex": "Rebuild the items index, after files in the data folder were changed by hand",
+    "thumbs": "Build the thumbnails of all items that do not have one cached yet",
+}
+
+def reindex() -> None:
+    print(f"Indexed {rebuild_index()} items.")
+
+# items are read from the index and queued a few at a time, so that a large library is never held in memory all at once
+def thumbs() -> None:
+    thumb_jobs.start()
+    total = 0
+    for item in iter_items():
+        while thumb_jobs.queue.qsize() >= THUMBS_BACKLOG:
+            time.sleep(0.1)
+        warm_thumbs([item])
+        if (total := total + 1) % THUMBS_BACKLOG == 0:
+            print(f"\r{total - thumb_jobs.queue.unfinished_tasks}/{total} items...", end="", flush=True)
+    thumb_jobs.queue.join()
+    print(f"\r{total}/{total} items, {thumb_jobs.stats()}")
+
+THUMBS_BACKLOG = 100
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1] not in COMMANDS:
+        print("Usage: python manage.py <command>\n")
+        for name, description in COMMANDS.items():
+            print(f"  {name}\t{description}")
+        sys.exit(1)
+    globals()[sys.argv[1]]()
@@ -209,14 +209,12 @@ up.compiler('.notifications.placeholder', target => {
   target.classList.toggle('content');
   up.request('/notifications').then(response => {
     up.render({ target: '.notifications.content', response });
-    var count = document.querySelectorAll('nav .notifications > ul.events > li').length;
-    if (count > 0) {
-      var badge = document.querySelector('nav .uk-badge');
-      badge.textContent = count;
-      if (document.querySelector('nav .notifications > .load-wrapper > a')) {
-        badge.textContent += '+';
-      }
-      badge.hidden = false;
+  });
+  var badge = document.querySelector('nav .uk-badge');
+  badge.previousElementSibling.addEventListener('click', () => {
+    if (!badge.hidden) {
+      up.request('/notifications', { method: 'POST' });
+      badge.hidden = true;
     }
   });
 });